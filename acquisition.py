@@ -0,0 +1,147 @@
+'''
+Destination choice over a restricted set of candidate points, so that a UGV doesn't need a
+prediction of its whole region on every step.
+'''
+
+import heapq
+import math
+import numpy as np
+
+from model import *
+
+
+def lattice_axis(lo, hi, step):
+    '''
+    Indices from lo to hi - 1 with step between them, always including hi - 1, where the variance
+    is often highest.
+    '''
+    return np.union1d(np.arange(lo, hi, step), [hi - 1])
+
+
+class Acquisition(object):
+    '''
+    Finds the candidate point with the highest predicted variance. Candidates are a coarse lattice
+    over the region, plus fine neighbourhoods around new samples and around each chosen point.
+
+    Scores are kept in a max-heap. With fixed hyperparameters, new samples can only lower the
+    variance, so old scores are upper bounds until the model is refit. After a sample, only the
+    candidates near it are rescored right away; others are rescored once they reach the top of the
+    heap. After a refit, every candidate is rescored.
+    '''
+    def __init__(self, model, rgn, lattice_points=256, batch=64):
+        '''
+        Create a new acquisition engine.
+
+        Args:
+        * model: The Model to score candidates with.
+        * rgn: Region in which to choose points.
+        * lattice_points: Approximate amount of points in the coarse lattice.
+        * batch: Amount of stale candidates rescored at once.
+        '''
+        self.model = model
+        self.rgn = rgn
+        self.batch = batch
+        shape = rgn.shape(model.d3)
+        axes = sum(1 for n in shape if n > 1)
+        cells = int(np.prod(shape))
+        # Spacing of the coarse lattice, and half-width of the neighbourhoods.
+        self.spacing = max(1, int(math.ceil((cells / lattice_points) ** (1 / max(axes, 1)))))
+        self.__lo = np.array([rgn.a.x, rgn.a.y, rgn.a.z] if model.d3 else [rgn.a.x, rgn.a.z])
+        self.__hi = self.__lo + np.array(shape)
+        # Candidate (a tuple of model coordinates) -> (variance, model version it was scored at)
+        self.__scores = {}
+        self.__heap = []
+        # Candidates whose neighbourhood was already added
+        self.__refined = set()
+        # Amount of hyperparameter fits and of model samples when candidates were last updated
+        self.__fits = None
+        self.__seen = len(model.input)
+        lattice = np.meshgrid(*[lattice_axis(lo, hi, self.spacing) for lo, hi in zip(self.__lo, self.__hi)],
+                              indexing="ij")
+        self.__lattice = [tuple(int(v) for v in p) for p in np.stack([g.ravel() for g in lattice], axis=1)]
+
+    def __len__(self):
+        return len(self.__scores)
+
+    def neighbourhood(self, center):
+        '''
+        Points in the region within self.spacing of center on each axis, with a quarter of the spacing
+        between them, including the center and the edges of the region that are in reach.
+        '''
+        step = max(1, self.spacing // 4)
+        axes = []
+        for c, lo, hi in zip(center, self.__lo, self.__hi):
+            c = min(max(int(round(c)), lo), hi - 1)
+            a, b = max(c - self.spacing, lo), min(c + self.spacing, hi - 1)
+            axes.append(np.union1d(lattice_axis(a, b + 1, step), [c]))
+        grids = np.meshgrid(*axes, indexing="ij")
+        return [tuple(int(v) for v in p) for p in np.stack([g.ravel() for g in grids], axis=1)]
+
+    def near(self, center):
+        '''
+        Candidates within self.spacing of center on each axis.
+        '''
+        return [p for p in self.__scores if all(abs(a - b) <= self.spacing for a, b in zip(p, center))]
+
+    def score(self, points, var=None):
+        '''
+        Pushes new scores for points onto the heap. var is their variances, or None to predict them.
+        '''
+        if len(points) == 0:
+            return
+        if var is None:
+            _, var = self.model.predict_lattice(np.array(points, dtype=float), "var")
+        version = self.model.version
+        for p, v in zip(points, var):
+            v = float(v)
+            self.__scores[p] = (v, version)
+            heapq.heappush(self.__heap, (-v, version, p))
+
+    def update(self):
+        '''
+        Finds the candidates affected by samples added since the last update, and adds new candidates
+        around those samples. Returns them all, sorted, for score(). best() does this itself; a
+        fleet calls it to score the candidates of all of its robots at once.
+        '''
+        # Refit now, if it's due, so that opt_log shows whether the hyperparameters changed.
+        self.model.regression
+        centers = self.model.input[self.__seen:]
+        self.__seen = len(self.model.input)
+        if self.__fits != len(self.model.opt_log):
+            self.__fits = len(self.model.opt_log)
+            points = set(self.__scores) | set(self.__lattice)
+            self.__scores = {}
+            self.__heap = []
+        else:
+            points = set()
+            for c in centers:
+                points.update(self.near(c))
+        for c in centers:
+            points.update(self.neighbourhood(c))
+        return sorted(points)
+
+    def best(self):
+        '''
+        Returns the candidate with the highest variance, as a Vector, after refining the candidates around it.
+        '''
+        self.score(self.update())
+        while True:
+            neg, version, point = self.__heap[0]
+            if self.__scores[point] != (-neg, version):
+                # Superseded by a newer score
+                heapq.heappop(self.__heap)
+            elif version != self.model.version:
+                stale = []
+                while len(self.__heap) > 0 and len(stale) < self.batch:
+                    neg, version, point = heapq.heappop(self.__heap)
+                    if self.__scores[point] == (-neg, version):
+                        stale.append(point)
+                self.score(stale)
+            elif point not in self.__refined:
+                self.__refined.add(point)
+                self.score([p for p in self.neighbourhood(point) if p not in self.__scores])
+            else:
+                break
+        if self.model.d3:
+            return Vector(point[0], point[1], point[2])
+        return Vector(point[0], 0, point[1])
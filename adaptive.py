@@ -0,0 +1,278 @@
+'''
+Adaptive-resolution predictions, which only predict every cell where the posterior changes sharply
+or comes near its maximum.
+'''
+
+import itertools
+import numpy as np
+from region import *
+
+
+class Tile(object):
+    '''
+    A box of lattice indices, lo to hi inclusive on each axis, in an AdaptivePrediction's tree.
+    '''
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+        # None for a leaf
+        self.children = None
+
+    @property
+    def splittable(self):
+        return any(h - l >= 2 for l, h in zip(self.lo, self.hi))
+
+    @property
+    def width(self):
+        return max(h - l for l, h in zip(self.lo, self.hi))
+
+    @property
+    def center(self):
+        '''
+        The index shared by every child of the tile.
+        '''
+        return tuple((l + h) // 2 if h - l >= 2 else l for l, h in zip(self.lo, self.hi))
+
+    def corners(self):
+        '''
+        The tile's corners, in the order of itertools.product((0, 1), repeat=dims), where 1 is hi.
+        On axes where lo == hi, corners are repeated.
+        '''
+        return list(itertools.product(*[(l, h) for l, h in zip(self.lo, self.hi)]))
+
+    def split(self):
+        '''
+        Splits the tile in half on each axis that's at least 2 wide, giving a quadtree in 2D and an
+        octree in 3D. Neighbouring children share their boundary indices.
+        '''
+        axes = []
+        for l, h in zip(self.lo, self.hi):
+            if h - l >= 2:
+                m = (l + h) // 2
+                axes.append([(l, m), (m, h)])
+            else:
+                axes.append([(l, h)])
+        self.children = [Tile(tuple(b[0] for b in box), tuple(b[1] for b in box)) for box in itertools.product(*axes)]
+        return self.children
+
+    def find(self, index):
+        '''
+        The leaf containing index, which must be inside this tile.
+        '''
+        tile = self
+        while tile.children is not None:
+            tile = next(c for c in tile.children if all(l <= i <= h for l, i, h in zip(c.lo, index, c.hi)))
+        return tile
+
+
+def interpolate(lo, hi, corners, points):
+    '''
+    Multilinear interpolation inside boxes.
+
+    Args:
+    * lo, hi: (N, dims) arrays of the boxes' lowest and highest corners.
+    * corners: (N, 2^dims) array of the values at each box's corners, ordered as in Tile.corners().
+    * points: (N, dims) array of one point in each box, or (N, M, dims) array of M points in each box.
+
+    Returns an (N,) or (N, M) array.
+    '''
+    width = np.maximum(hi - lo, 1).astype(float)
+    if points.ndim == 2:
+        t = (points - lo) / width
+    else:
+        t = (points - lo[:, None, :]) / width[:, None, :]
+    res = 0
+    for i, corner in enumerate(itertools.product((0, 1), repeat=lo.shape[1])):
+        weight = 1
+        for axis, c in enumerate(corner):
+            weight = weight * (t[..., axis] if c else 1 - t[..., axis])
+        res = res + weight * (corners[:, i] if t.ndim == 2 else corners[:, i, None])
+    return res
+
+
+class AdaptivePrediction(LatticeValues):
+    '''
+    A prediction over a region that's refined where it matters. Tiles of the region's lattice are
+    predicted at their corners, starting from tiles about coarse cells wide. Each tile is also predicted
+    at its center, and split in half if the center is more than tol away from the interpolation of the
+    corners (as a fraction of the range of values over the region), if it contains a sample, or if any
+    of its target values are within near of the highest one found and they differ by more than tol.
+    Tiles are split until they're flat or a single cell wide.
+
+    Cells that weren't predicted are interpolated from their tile's corners. argmax() and argmin() only
+    consider predicted cells, around which the tree is refined to single cells.
+
+    Like a model.Prediction, it has mean, var, values(), argmax(), argmin() and position(), so it can be
+    used in place of one where only those are needed, as in UAV.suggest() and UGV.update_dest(). It
+    doesn't have sub(), top_k(), nbytes or cleaned_vals().
+    '''
+    def __init__(self, rgn, predict, d3=False, target="var", coarse=16, tol=0.05, near=0.05, samples=None):
+        '''
+        Predicts a region adaptively.
+
+        Args:
+        * rgn: The Region to predict.
+        * predict: Function that takes an (N, dims) array of points and returns flat arrays of their
+          posterior mean and variance, ex. Model.predict_lattice.
+        * d3: Whether this is a 3D prediction or not.
+        * target: "mean" or "var"; the tree is refined around the highest values of this.
+        * coarse: Width of the tiles that are always split.
+        * tol: Largest error of a flat tile's interpolation, as a fraction of the range of values.
+        * near: Tiles with a target value within this fraction of the range of values of the highest one are refined.
+        * samples: (N, dims) array of the model's sample positions, or None.
+        '''
+        assert(target in ("mean", "var"))
+        self.rgn = rgn
+        self.d3 = d3
+        self.shape = rgn.shape(d3)
+        self.target = target
+        self.__predict = predict
+        self.__offset = np.array([rgn.a.x, rgn.a.y, rgn.a.z] if d3 else [rgn.a.x, rgn.a.z])
+        # Predicted cell -> its position in self.indices and self.values_at
+        self.__cells = {}
+        self.indices = np.empty((0, len(self.shape)), dtype=int)
+        self.values_at = {"mean": np.empty(0), "var": np.empty(0)}
+        self.__mean = None
+        self.__var = None
+        if samples is not None and len(samples) > 0:
+            samples = np.asarray(samples, dtype=float) - self.__offset
+        else:
+            samples = np.empty((0, len(self.shape)))
+        self.root = Tile(tuple(0 for n in self.shape), tuple(n - 1 for n in self.shape))
+        self.__evaluate([c for c in self.root.corners()])
+        tiles = [self.root]
+        while len(tiles) > 0:
+            tiles = [t for t in tiles if t.splittable]
+            wide = [t for t in tiles if t.width > coarse]
+            refine = wide + self.__sharp([t for t in tiles if t.width <= coarse], tol, near, samples)
+            tiles = [c for t in refine for c in t.split()]
+            self.__evaluate([c for t in tiles for c in t.corners()])
+
+    def __len__(self):
+        '''
+        Amount of cells that were predicted.
+        '''
+        return len(self.indices)
+
+    def __evaluate(self, cells):
+        '''
+        Predicts the cells that weren't predicted yet, in one call.
+        '''
+        new = []
+        for c in cells:
+            if c not in self.__cells:
+                self.__cells[c] = len(self.__cells)
+                new.append(c)
+        if len(new) == 0:
+            return
+        new = np.array(new, dtype=int)
+        mean, var = self.__predict((new + self.__offset).astype(float))
+        self.indices = np.concatenate([self.indices, new])
+        self.values_at = {
+            "mean": np.concatenate([self.values_at["mean"], np.asarray(mean).reshape(-1)]),
+            "var": np.concatenate([self.values_at["var"], np.asarray(var).reshape(-1)]),
+        }
+
+    def __corner_values(self, tiles, which):
+        '''
+        (N, 2^dims) array of the values at the corners of tiles.
+        '''
+        rows = [[self.__cells[c] for c in t.corners()] for t in tiles]
+        return self.values_at[which][np.array(rows, dtype=int).reshape(len(tiles), -1)]
+
+    def __sharp(self, tiles, tol, near, samples):
+        '''
+        The tiles that should be split.
+        '''
+        if len(tiles) == 0:
+            return []
+        self.__evaluate([t.center for t in tiles])
+        lo = np.array([t.lo for t in tiles])
+        hi = np.array([t.hi for t in tiles])
+        centers = np.array([self.__cells[t.center] for t in tiles])
+        split = np.zeros(len(tiles), dtype=bool)
+        for which, vals in self.values_at.items():
+            spread = np.ptp(vals)
+            corners = self.__corner_values(tiles, which)
+            guess = interpolate(lo, hi, corners, np.array([t.center for t in tiles]))
+            split |= np.abs(vals[centers] - guess) > tol * spread
+            if which == self.target:
+                # A flat tile can't hide a higher value, even near the top.
+                highest = np.maximum(corners.max(axis=1), vals[centers])
+                lowest = np.minimum(corners.min(axis=1), vals[centers])
+                split |= (highest >= vals.max() - near * spread) & (highest - lowest > tol * spread)
+        for s in samples:
+            split |= np.all((lo <= s) & (s <= hi), axis=1)
+        return [t for t, s in zip(tiles, split) if s]
+
+    def leaves(self):
+        '''
+        Every leaf of the tree.
+        '''
+        res = []
+        stack = [self.root]
+        while len(stack) > 0:
+            tile = stack.pop()
+            if tile.children is None:
+                res.append(tile)
+            else:
+                stack.extend(tile.children)
+        return res
+
+    def lookup(self, index, which="var"):
+        '''
+        The value of which at an index into the region's lattice, interpolated if it wasn't predicted.
+        '''
+        index = tuple(int(i) for i in index)
+        if index in self.__cells:
+            return float(self.values_at[which][self.__cells[index]])
+        tile = self.root.find(index)
+        return float(interpolate(np.array([tile.lo]), np.array([tile.hi]), self.__corner_values([tile], which),
+                                 np.array([index]))[0])
+
+    def __dense(self, which):
+        '''
+        Interpolates every cell, one batch of same-sized leaves at a time.
+        '''
+        res = np.empty(self.shape)
+        groups = {}
+        for tile in self.leaves():
+            groups.setdefault(tuple(h - l for l, h in zip(tile.lo, tile.hi)), []).append(tile)
+        for size, tiles in groups.items():
+            offsets = np.stack([g.ravel() for g in np.meshgrid(*[np.arange(n + 1) for n in size], indexing="ij")],
+                               axis=1)
+            lo = np.array([t.lo for t in tiles])
+            cells = lo[:, None, :] + offsets[None, :, :]
+            vals = interpolate(lo, np.array([t.hi for t in tiles]), self.__corner_values(tiles, which), cells)
+            res[tuple(cells.reshape(-1, len(size)).T)] = vals.ravel()
+        return res
+
+    @property
+    def mean(self):
+        '''
+        Mean at every cell, interpolated where it wasn't predicted. Computed on first use.
+        '''
+        if self.__mean is None:
+            self.__mean = self.__dense("mean")
+        return self.__mean
+
+    @property
+    def var(self):
+        '''
+        Variance at every cell, interpolated where it wasn't predicted. Computed on first use.
+        '''
+        if self.__var is None:
+            self.__var = self.__dense("var")
+        return self.__var
+
+    def argmax(self, which="var"):
+        '''
+        Index of the predicted cell with the highest mean or variance.
+        '''
+        return tuple(int(i) for i in self.indices[np.argmax(self.values_at[which])])
+
+    def argmin(self, which="mean"):
+        '''
+        Index of the predicted cell with the lowest mean or variance.
+        '''
+        return tuple(int(i) for i in self.indices[np.argmin(self.values_at[which])])
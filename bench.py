@@ -0,0 +1,182 @@
+#! /usr/bin/env python3
+
+'''
+Executable file that benchmarks the model, map and planner hot paths across map sizes and sample
+counts, and compares the results against a saved baseline.
+'''
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from model import *
+from robot import *
+
+
+class Context(object):
+    '''
+    The map, model and robots that a benchmark runs against. Built outside of the timed code.
+    '''
+    def __init__(self, size, samples, seed):
+        '''
+        Args:
+        * size: Width and depth of the (2D) map.
+        * samples: Amount of samples in the model, at random points of the map.
+        * seed: Seed for the map and the sample positions.
+        '''
+        rng = np.random.default_rng(seed)
+        self.grid = Map(size=(size, 0, size), seed=rng)
+        self.rgn = Region((0, 0, 0), self.grid.size)
+        self.model = Model(False)
+        points = rng.integers(0, size, (samples, 2))
+        self.model.sample_many([(Vector(int(x), 0, int(z)), self.grid.sample(Vector(int(x), 0, int(z))))
+                                for x, z in points])
+        self.model.regression
+        self.uav = UAV(self.grid, self.rgn, self.model, 0, 4)
+        self.ugv = UGV(self.grid, self.model, self.rgn.a, 8, self.rgn, samples + 1, rng=rng)
+
+    def clear_predictions(self):
+        '''
+        Drops cached predictions, so that each repeat does the full work.
+        '''
+        self.model.predictions = PredictionCache(self.model.predictions.max_bytes)
+
+
+def bench_regression(ctx):
+    ctx.model.invalidate()
+    ctx.model.regression
+
+
+def bench_predict(ctx):
+    ctx.clear_predictions()
+    ctx.model.predict(ctx.rgn, "both")
+
+
+def bench_predict_adaptive(ctx):
+    AdaptivePrediction(ctx.rgn, ctx.model.predict_lattice, False, "var", samples=np.array(ctx.model.input))
+
+
+def bench_rmse(ctx):
+    ctx.clear_predictions()
+    ctx.model.rmse(ctx.grid)
+
+
+def bench_map_field(ctx):
+    Map(size=ctx.grid.size, seed=0).field
+
+
+def bench_sample_rgn(ctx):
+    ctx.grid.sample_rgn(ctx.rgn)
+
+
+def bench_suggest(ctx):
+    ctx.clear_predictions()
+    ctx.uav.candidates(1)
+
+
+def bench_update_dest(ctx):
+    ctx.clear_predictions()
+    ctx.ugv.update_dest()
+    ctx.ugv.samples += 1
+
+
+BENCHMARKS = {
+    "regression": bench_regression,
+    "predict": bench_predict,
+    "predict_adaptive": bench_predict_adaptive,
+    "rmse": bench_rmse,
+    "map_field": bench_map_field,
+    "sample_rgn": bench_sample_rgn,
+    "suggest": bench_suggest,
+    "update_dest": bench_update_dest,
+}
+
+
+def measure(fn, ctx, repeats):
+    '''
+    Times repeats calls of fn(ctx), after one untimed warmup call, then measures the peak memory
+    allocated during one more call. Returns a dict of timing percentiles (s) and peak memory (bytes).
+    '''
+    fn(ctx)
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn(ctx)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "median": float(np.median(times)),
+        "p90": float(np.percentile(times, 90)),
+        "p99": float(np.percentile(times, 99)),
+        "peak": peak,
+    }
+
+
+def run(benchmarks, sizes, samples, repeats=5, seed=0):
+    '''
+    Runs every benchmark for every combination of map size and sample count.
+    Returns a dict from "benchmark/size/samples" to the output of measure().
+    '''
+    res = {}
+    for size in sizes:
+        for sample_amt in samples:
+            ctx = Context(size, sample_amt, seed)
+            for name in benchmarks:
+                key = f"{name}/{size}/{sample_amt}"
+                res[key] = measure(BENCHMARKS[name], ctx, repeats)
+                r = res[key]
+                print(f"{key:<28} median {r['median'] * 1000:10.3f}ms  p90 {r['p90'] * 1000:10.3f}ms  "
+                      f"p99 {r['p99'] * 1000:10.3f}ms  peak {r['peak'] / 1024 / 1024:9.2f}MB")
+    return res
+
+
+def compare(res, baseline, threshold):
+    '''
+    Finds benchmarks whose median time is more than threshold (ex. 0.1 for 10%) slower than
+    in baseline. Returns a list of [key, baseline median, median].
+    '''
+    slower = []
+    for key, r in res.items():
+        if key in baseline and r["median"] > baseline[key]["median"] * (1 + threshold):
+            slower.append([key, baseline[key]["median"], r["median"]])
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WiFi Mapper Benchmarks')
+    parser.add_argument("-b", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS), dest="benchmarks", help="Benchmarks to run.")
+    parser.add_argument("-s", type=int, nargs="+", default=[12, 64, 256, 1024], dest="sizes", help="Map sizes. (The maps are 2D.)")
+    parser.add_argument("-m", type=int, nargs="+", default=[50, 200], dest="samples", help="Amounts of samples in the model.")
+    parser.add_argument("-n", type=int, default=5, dest="repeats", help="Timed repeats of each benchmark.")
+    parser.add_argument("--seed", type=int, default=0, dest="seed", help="Seed for the maps and samples.")
+    parser.add_argument("--save", default=None, dest="save", help="Save results as a JSON baseline to this file.")
+    parser.add_argument("--baseline", default=None, dest="baseline", help="Compare results to a baseline saved with --save.")
+    parser.add_argument("--threshold", type=float, default=0.1, dest="threshold", help="Fraction by which a median may be slower than the baseline.")
+    args = parser.parse_args()
+
+    res = run(args.benchmarks, args.sizes, args.samples, args.repeats, args.seed)
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(res, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = compare(res, baseline, args.threshold)
+        for key, old, new in slower:
+            print(f"Regression: {key}: {old * 1000:.3f}ms -> {new * 1000:.3f}ms")
+        if len(slower) > 0:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+'''
+A content-addressed cache on disk, for reusing map ground truth and UAV results between runs.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+
+class DiskCache(object):
+    '''
+    Stores files in one directory per key, under a root directory. Keys are hashes of whatever
+    determines the contents (see key()), so entries never go stale, and runs in several
+    processes can share a cache.
+
+    Every use of an entry marks it as recently used. When the cache grows beyond max_bytes, the
+    least recently used entries are deleted.
+    '''
+    def __init__(self, path, max_bytes=1024 * 1024 * 1024):
+        '''
+        Create a new cache, or open an existing one.
+
+        Args:
+        * path: Root directory of the cache.
+        * max_bytes: Size cap for every entry together.
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        '''
+        Hashes parts, which should be JSON-like values, into a key. Other values are hashed by str().
+        '''
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def __file(self, key, name):
+        return os.path.join(self.path, key, name)
+
+    def __touch(self, key):
+        os.utime(os.path.join(self.path, key))
+
+    def __write(self, key, name, write):
+        '''
+        Writes a file with write(file object), replacing it atomically so readers never see half of it.
+        '''
+        os.makedirs(os.path.join(self.path, key), exist_ok=True)
+        path = self.__file(key, name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+        self.__touch(key)
+        self.evict(keep=key)
+
+    def load_json(self, key, name):
+        '''
+        Gets a JSON value from an entry, or None if it isn't cached.
+        '''
+        path = self.__file(key, name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            res = json.load(f)
+        self.__touch(key)
+        return res
+
+    def save_json(self, key, name, value):
+        self.__write(key, name, lambda f: f.write(json.dumps(value).encode()))
+
+    def load_array(self, key, name):
+        '''
+        Gets a read-only, memory-mapped numpy array from an entry, or None if it isn't cached.
+        '''
+        path = self.__file(key, name)
+        if not os.path.exists(path):
+            return None
+        res = np.load(path, mmap_mode="r")
+        self.__touch(key)
+        return res
+
+    def save_array(self, key, name, array):
+        self.__write(key, name, lambda f: np.save(f, array))
+
+    def field(self, grid):
+        '''
+        Gives grid its field from the cache, or computes it and adds it to the cache.
+        '''
+        if grid.has_field:
+            return
+        key = grid.key()
+        field = self.load_array(key, "field.npy")
+        if field is not None:
+            grid.set_field(field)
+        else:
+            self.save_array(key, "field.npy", grid.field)
+
+    def entries(self):
+        '''
+        Returns a list of [key, size in bytes, last use time] for each entry.
+        '''
+        res = []
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                res.append([key, size, os.path.getmtime(entry)])
+            except FileNotFoundError:
+                # Deleted by another process while it was being read
+                continue
+        return res
+
+    @property
+    def nbytes(self):
+        return sum(size for key, size, used in self.entries())
+
+    def evict(self, keep=None):
+        '''
+        Deletes the least recently used entries, other than keep, until the cache fits in max_bytes.
+        '''
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for key, size, used in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+
+'''
+Executable file that runs tests.compare() over a sweep of parameters and seeds in a process pool,
+then aggregates the RMSE logs into means and confidence bands.
+'''
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import tests
+from sim import add_model_args, get_model_opts
+from telemetry import JSONTelemetry
+
+
+def run_seed(params, i, base_seed=0):
+    '''
+    Gets the seed for the i-th run of a set of parameters. It only depends on the parameters,
+    i and base_seed, so it doesn't matter what order runs are scheduled in.
+    '''
+    entropy = [base_seed, *params["size"], params["src_amt"], params["samples"], params["uav_rows"], params["radius"], i]
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+
+def run_key(params, seed, rmse_interval, model_opts):
+    '''
+    Identifies a run in a checkpoint file, by everything that changes its results, so that a sweep
+    with other settings doesn't reuse it. The telemetry sink, if any, is left out.
+    '''
+    model_opts = {k: v for k, v in model_opts.items() if k != "telemetry"}
+    return json.dumps([params, seed, rmse_interval, model_opts], sort_keys=True, default=str)
+
+
+def run(params, seed, rmse_interval, model_opts, telemetry_dir=None):
+    '''
+    Runs one comparison between a variance robot and a random robot. This is what runs in
+    each worker process. If telemetry_dir is set, the run's events are streamed to
+    telemetry_dir/<seed>.jsonl while it runs.
+    '''
+    telemetry = None
+    if telemetry_dir is not None:
+        telemetry = JSONTelemetry(os.path.join(telemetry_dir, f"{seed}.jsonl"))
+        model_opts = dict(model_opts, telemetry=telemetry)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            v_rmse, r_rmse = tests.compare(params["size"], params["src_amt"], params["samples"], params["uav_rows"],
+                                           params["radius"], rmse_interval, False, seed, **model_opts)
+    finally:
+        if telemetry is not None:
+            telemetry.close()
+    return {"params": params, "seed": seed, "rmse_interval": rmse_interval,
+            "model_opts": {k: v for k, v in model_opts.items() if k != "telemetry"},
+            "variance": v_rmse, "random": r_rmse}
+
+
+def load_checkpoint(path):
+    '''
+    Reads the finished runs from a checkpoint file, keyed by run_key(). Returns an empty dict
+    if there's no checkpoint. A partially written last line, from an interrupted sweep, is ignored,
+    and so are runs recorded without their settings.
+    '''
+    done = {}
+    if path is None or not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                res = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "rmse_interval" not in res or "model_opts" not in res:
+                continue
+            done[run_key(res["params"], res["seed"], res["rmse_interval"], res["model_opts"])] = res
+    return done
+
+
+def sweep(sizes, src_amts, samples, uav_rows, radii, seeds,
+          workers=None, checkpoint=None, rmse_interval=1, base_seed=0, model_opts=None, telemetry_dir=None):
+    '''
+    Runs a comparison for every combination of parameters, seeds times each, in a process pool.
+    Returns the results of every run, in the order of the parameter combinations.
+
+    Args:
+    * sizes, src_amts, samples, uav_rows, radii: Lists of values for the arguments of tests.compare().
+    * seeds: Amount of runs for each combination of parameters.
+    * workers: Amount of worker processes. If None, one per CPU.
+    * checkpoint: Path of a JSON lines file that each finished run is appended to. Runs that are
+      already in it with the same rmse_interval and model_opts are skipped, so an interrupted sweep
+      can be resumed.
+    * rmse_interval: Samples between RMSE logs.
+    * base_seed: Changes the seed of every run.
+    * model_opts: Keyword arguments for the Model.
+    * telemetry_dir: If set, each run streams its events to a JSON lines file in this directory.
+    '''
+    if model_opts is None:
+        model_opts = {}
+    runs = []
+    for size, src_amt, sample_amt, rows, radius in itertools.product(sizes, src_amts, samples, uav_rows, radii):
+        params = {"size": list(size), "src_amt": src_amt, "samples": sample_amt, "uav_rows": rows, "radius": radius}
+        for i in range(seeds):
+            runs.append((params, run_seed(params, i, base_seed)))
+
+    done = load_checkpoint(checkpoint)
+    pending = [(params, seed) for params, seed in runs if run_key(params, seed, rmse_interval, model_opts) not in done]
+    # Progress goes to stderr, so that stdout is only the aggregate CSV.
+    print(f"Runs: {len(runs)}, already done: {len(runs) - len(pending)}", file=sys.stderr)
+    if telemetry_dir is not None:
+        os.makedirs(telemetry_dir, exist_ok=True)
+    if len(pending) > 0:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(run, params, seed, rmse_interval, model_opts, telemetry_dir) for params, seed in pending]
+            for i, future in enumerate(as_completed(futures)):
+                res = future.result()
+                done[run_key(res["params"], res["seed"], rmse_interval, model_opts)] = res
+                if checkpoint is not None:
+                    with open(checkpoint, "a") as f:
+                        f.write(json.dumps(res) + "\n")
+                print(f"Finished {i + 1}/{len(pending)}: {res['params']} seed {res['seed']}", file=sys.stderr)
+    return [done[run_key(params, seed, rmse_interval, model_opts)] for params, seed in runs]
+
+
+def aggregate(results):
+    '''
+    Groups results by parameters, and gets the mean RMSE at each logged sample along with the
+    half-width of its 95% confidence interval, for both robots.
+
+    Returns a list of dicts with "params", "runs", and "variance" and "random" lists of
+    [mean, half-width] pairs.
+    '''
+    groups = {}
+    for res in results:
+        groups.setdefault(json.dumps(res["params"], sort_keys=True), []).append(res)
+    agg = []
+    for runs in groups.values():
+        # Logs can differ in length between seeds, so only the samples that every run reached are used.
+        length = min(min(len(r["variance"]), len(r["random"])) for r in runs)
+        entry = {"params": runs[0]["params"], "runs": len(runs)}
+        for robot in ("variance", "random"):
+            logs = np.array([r[robot][:length] for r in runs])
+            mean = logs.mean(axis=0)
+            if len(runs) > 1:
+                half = 1.96 * logs.std(axis=0, ddof=1) / math.sqrt(len(runs))
+            else:
+                half = np.zeros(length)
+            entry[robot] = [[float(m), float(h)] for m, h in zip(mean, half)]
+        agg.append(entry)
+    return agg
+
+
+def aggregate_csv(agg):
+    '''
+    Generates a CSV formatted string from the output of aggregate().
+    '''
+    lines = ["Size X,Size Y,Size Z,Sources,UGV Samples,UAV Rows,Radius,Runs,Sample,"
+             "Variance RMSE,Variance CI,Random RMSE,Random CI\n"]
+    for entry in agg:
+        p = entry["params"]
+        prefix = f"{p['size'][0]},{p['size'][1]},{p['size'][2]},{p['src_amt']},{p['samples']},{p['uav_rows']}," \
+                 f"{p['radius']},{entry['runs']}"
+        for i, (v, r) in enumerate(zip(entry["variance"], entry["random"])):
+            lines.append(f"{prefix},{i + 1},{v[0]},{v[1]},{r[0]},{r[1]}\n")
+    return "".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WiFi Mapper Experiments')
+    parser.add_argument("-s", type=int, nargs=3, action="append", dest="sizes", help="Grid size. [x, y, z] Can be repeated.")
+    parser.add_argument("-a", type=int, nargs="+", default=[1], dest="src_amts", help="Amounts of signal sources.")
+    parser.add_argument("-m", type=int, nargs="+", default=[12], dest="samples", help="Amounts of UGV samples.")
+    parser.add_argument("-v", type=int, nargs="+", default=[4], dest="uav_rows", help="Amounts of UAV rows.")
+    parser.add_argument("-r", type=int, nargs="+", default=[8], dest="radii", help="UGV movement radii.")
+    parser.add_argument("-n", type=int, default=10, dest="seeds", help="Amount of runs (seeds) for each combination of parameters.")
+    parser.add_argument("--seed", type=int, default=0, dest="base_seed", help="Base seed that every run's seed is derived from.")
+    parser.add_argument("--rmse", type=int, default=1, dest="rmse", help="Interval between RMSE logs.")
+    parser.add_argument("--workers", type=int, default=None, dest="workers", help="Amount of worker processes. Defaults to one per CPU.")
+    parser.add_argument("--checkpoint", default=None, dest="checkpoint", help="JSON lines file to record finished runs in, and resume from.")
+    parser.add_argument("--telemetry", default=None, dest="telemetry", help="Directory to stream each run's events to, as <seed>.jsonl.")
+    add_model_args(parser)
+    args = parser.parse_args()
+    if args.sizes is None:
+        args.sizes = [[12, 0, 12]]
+
+    results = sweep(args.sizes, args.src_amts, args.samples, args.uav_rows, args.radii, args.seeds,
+                    args.workers, args.checkpoint, args.rmse, args.base_seed, get_model_opts(args), args.telemetry)
+    print(aggregate_csv(aggregate(results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+'''
+Simulation of several robots that share one model.
+'''
+
+from robot import *
+
+
+class Fleet(object):
+    '''
+    Steps several robots on a shared clock against one shared Model. On each tick, every robot
+    that isn't done moves and samples, the samples go into the model as one update, and new
+    destinations are chosen from one batched prediction.
+    '''
+    def __init__(self, model, robots, rmse_log_interval=0):
+        '''
+        Create a new fleet.
+
+        Args:
+        * model: The Model that every robot samples to.
+        * robots: The robots. Their own RMSE logging should be off (rmse_log_interval=0).
+        * rmse_log_interval: Ticks between RMSE logs. 0 for none.
+        '''
+        assert(all(r.model is model for r in robots))
+        self.model = model
+        self.robots = robots
+        self.log_interval = rmse_log_interval
+        self.clock = 0
+        # Per-phase counts and times of the fleet's simulation. See Robot.find_source().
+        self.timer = Timer()
+
+    def done(self):
+        '''
+        True once every robot is done.
+        '''
+        return all(r.done() for r in self.robots)
+
+    def tick(self):
+        '''
+        Advance every robot that isn't done by one step.
+        '''
+        active = [r for r in self.robots if not r.done()]
+        # As in Robot.find_source, the first sample is taken at the starting position.
+        if self.clock > 0:
+            for r in active:
+                r.move_towards_dest()
+        with self.timer.phase("sample"):
+            self.model.sample_many([r.measure() for r in active])
+
+        if self.clock > 0:
+            with self.timer.phase("select"):
+                updating = [r for r in active if r.update_per_sample or r.pos == r.dest]
+                # Predict the variance over every region that's about to be searched at once. Each UGV's
+                # own prediction is then sliced from this one by the model's prediction cache.
+                ugvs = [r for r in updating if isinstance(r, UGV) and not r.rand]
+                rgns = [r.rgn for r in ugvs if r.acquisition is None]
+                if len(rgns) > 0:
+                    union = rgns[0]
+                    for rgn in rgns[1:]:
+                        union = union.union(rgn)
+                    self.model.predict(union, "var")
+                # Likewise, score the candidates that the new samples affect for every UGV with an
+                # Acquisition in one prediction. Refining around each UGV's best candidate still takes
+                # a small prediction of its own.
+                acquisitions = [r.acquisition for r in ugvs if r.acquisition is not None]
+                if len(acquisitions) > 0:
+                    points = [a.update() for a in acquisitions]
+                    union = sorted(set().union(*points))
+                    if len(union) > 0:
+                        _, var = self.model.predict_lattice(np.array(union, dtype=float), "var")
+                        scores = dict(zip(union, var))
+                        for a, p in zip(acquisitions, points):
+                            a.score(p, [scores[q] for q in p])
+                for r in updating:
+                    r.update_dest()
+
+        self.clock += 1
+        if self.log_interval != 0 and self.clock % self.log_interval == 0:
+            with self.timer.phase("rmse"):
+                self.model.log_rmse(self.robots[0].map)
+
+    def run(self):
+        '''
+        Simulate the fleet until every robot is done. Returns the total amount of samples taken.
+        '''
+        model_timer, self.model.timer = self.model.timer, self.timer
+        try:
+            while not self.done():
+                self.tick()
+        finally:
+            self.model.timer = model_timer
+        return sum(r.sample_amt for r in self.robots)
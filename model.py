@@ -1,129 +1,421 @@
 import GPy as gp
+import copy
 import numpy as np
+import time
+from collections import OrderedDict
+from scipy.cluster.vq import kmeans2
 from region import *
+from posterior import *
+from adaptive import *
 
-class Prediction(object):
+class Prediction(LatticeValues):
     '''
-    An object holding the prediected mean and variance,
-    as well as the sorted versions of each.
+    An object holding the predicted mean and variance over a region. Positions are implicit;
+    index (0, 0) of each array is rgn.a.
     '''
-    def __init__(self, mean, var, d3=False):
+    def __init__(self, rgn, mean, var, d3=False, source=None):
         '''
         Create a new prediction.
 
         Args:
-        * mean: 2- or 3-d list of tuples of [(position, predicted mean)]
+        * rgn: The Region covered by this prediction.
+        * mean: Numpy array of predicted means, shaped rgn.shape(d3) and indexed relative to rgn.a,
+          or None to get it from source when it's first used.
         * var: As with mean, but with variance instead of mean.
         * d3: Whether this is a 3D prediction or not.
+        * source: Function that takes "mean" or "var" and returns that array. Needed if mean or var is None.
         '''
-        self.mean = mean
-        self.var = var
+        self.rgn = rgn
         self.d3 = d3
-        self.__m_mean = None
-        self.__m_var = None
+        self.shape = rgn.shape(d3)
+        self.__source = source
+        self.__mean = None if mean is None else np.ascontiguousarray(mean, dtype=float)
+        self.__var = None if var is None else np.ascontiguousarray(var, dtype=float)
 
     @property
-    def sorted_mean(self):
+    def mean(self):
         '''
-        self.mean sorted by highest mean.
+        Predicted mean at each point. Computed on first use if it wasn't given.
         '''
-        if self.__m_mean is None:
-            self.calc_sorted()
-        return self.__m_mean
+        if self.__mean is None:
+            self.__mean = np.ascontiguousarray(self.__source("mean"), dtype=float)
+        return self.__mean
 
     @property
-    def sorted_var(self):
+    def var(self):
         '''
-        self.var sorted by highest variance.
+        Predicted variance at each point. Computed on first use if it wasn't given.
         '''
-        if self.__m_var is None:
-            self.calc_sorted()
-        return self.__m_var
+        if self.__var is None:
+            self.__var = np.ascontiguousarray(self.__source("var"), dtype=float)
+        return self.__var
 
-    def cleaned_vals(self):
+    def argmax(self, which="var"):
         '''
-        Returns self.mean and self.var without the position values.
+        Index of the highest value in self.mean or self.var. Ties go to the first index.
         '''
-        mean = []
-        var = []
-        if self.d3:
-            for x in range(len(self.mean)):
-                mean.append([])
-                var.append([])
-                for y in range(len(self.mean[x])):
-                    mean[x].append([])
-                    var[x].append([])
-                    for z in range(len(self.mean[x][y])):
-                        mean[x][y].append(self.mean[x][y][z][1])
-                        var[x][y].append(self.var[x][y][z][1])
-        else:
-            for x in range(len(self.mean)):
-                mean.append([])
-                var.append([])
-                for z in range(len(self.mean[x])):
-                    mean[x].append(self.mean[x][z][1])
-                    var[x].append(self.var[x][z][1])
-        return mean, var
+        vals = self.values(which)
+        return np.unravel_index(np.argmax(vals), vals.shape)
+
+    def argmin(self, which="mean"):
+        '''
+        Index of the lowest value in self.mean or self.var. Ties go to the first index.
+        '''
+        vals = self.values(which)
+        return np.unravel_index(np.argmin(vals), vals.shape)
 
-    def calc_sorted(self):
+    def top_k(self, k, which="var", largest=True):
         '''
-        Generates sorted versions of self.mean and self.var.
+        Indices of the k highest (or lowest, if not largest) values, best first.
+        Only the selected k values are sorted.
+        '''
+        vals = self.values(which).ravel()
+        if not largest:
+            vals = -vals
+        k = min(k, vals.size)
+        if k <= 0:
+            return []
+        best = np.argpartition(-vals, k - 1)[:k]
+        best = best[np.argsort(-vals[best], kind="stable")]
+        return [np.unravel_index(i, self.shape) for i in best]
+
+    def sub(self, rgn):
         '''
-        self.__m_mean = []
-        self.__m_var = []
+        The part of this prediction covering rgn, which must be inside self.rgn.
+        '''
+        shape = rgn.shape(self.d3)
         if self.d3:
-            for x in range(len(self.mean)):
-                for y in range(len(self.mean[x])):
-                    for z in range(len(self.mean[x][y])):
-                        self.__m_mean.append(self.mean[x][y][z])
-                        self.__m_var.append(self.var[x][y][z])
+            offset = (rgn.a.x - self.rgn.a.x, rgn.a.y - self.rgn.a.y, rgn.a.z - self.rgn.a.z)
         else:
-            for x in range(len(self.mean)):
-                for z in range(len(self.mean[x])):
-                    self.__m_mean.append(self.mean[x][z])
-                    self.__m_var.append(self.var[x][z])
-        self.__m_mean.sort(key=lambda p: p[1])
-        self.__m_var.sort(key=lambda p: p[1], reverse=True)
+            offset = (rgn.a.x - self.rgn.a.x, rgn.a.z - self.rgn.a.z)
+        cells = tuple(slice(o, o + n) for o, n in zip(offset, shape))
+        return Prediction(rgn, None, None, self.d3, lambda which: self.values(which)[cells])
+
+    @property
+    def nbytes(self):
+        '''
+        Size of the mean and variance arrays, whether or not they've been computed yet.
+        '''
+        return 2 * 8 * int(np.prod(self.shape))
+
+    def cleaned_vals(self):
+        '''
+        Returns self.mean and self.var. Kept for callers that expect the old position-free values.
+        '''
+        return self.mean, self.var
 
     def __str__(self):
-        return f"3D: {self.d3}, Mean: {self.clean_mean}\nVar: {self.clean_var}"
+        return f"3D: {self.d3}, Mean: {self.mean}\nVar: {self.var}"
+
+
+class PredictionCache(object):
+    '''
+    A least recently used cache of Predictions, keyed by region and model version, with a bound on
+    the memory used by the cached arrays.
+    '''
+    def __init__(self, max_bytes):
+        '''
+        Args:
+        * max_bytes: Maximum total size of cached prediction arrays.
+        '''
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.__entries = OrderedDict()
+
+    def get(self, rgn, version, d3=False):
+        '''
+        Gets the prediction of rgn for a model version. If only a region containing rgn is cached,
+        the prediction is sliced from it. Returns None on a miss.
+        '''
+        key = (rgn, version)
+        if key in self.__entries:
+            self.__entries.move_to_end(key)
+            return self.__entries[key]
+        for (c_rgn, c_version), pred in reversed(self.__entries.items()):
+            if c_version == version and c_rgn.contains_rgn(rgn, d3):
+                self.__entries.move_to_end((c_rgn, c_version))
+                return pred.sub(rgn)
+        return None
+
+    def put(self, version, pred):
+        '''
+        Caches a prediction made by a model version. Predictions of older versions can never be used
+        again, so they're dropped. Then, least recently used predictions are evicted until the cache
+        fits in max_bytes. A prediction larger than max_bytes isn't cached.
+        '''
+        for key in [k for k in self.__entries if k[1] != version]:
+            self.__remove(key)
+        if pred.nbytes > self.max_bytes:
+            return
+        key = (pred.rgn, version)
+        if key in self.__entries:
+            self.__remove(key)
+        while self.__entries and self.nbytes + pred.nbytes > self.max_bytes:
+            self.__remove(next(iter(self.__entries)))
+        self.__entries[key] = pred
+        self.nbytes += pred.nbytes
+
+    def __remove(self, key):
+        self.nbytes -= self.__entries.pop(key).nbytes
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+def inducing_points(X, amt, placement="kmeans", seed=0):
+    '''
+    Chooses inducing point positions for a sparse GP.
+
+    Args:
+    * X: (N, D) array of sample positions.
+    * amt: Amount of inducing points. With "grid", this is rounded up to a full lattice.
+    * placement: "grid" for a regular lattice over the samples' bounding box, "kmeans" for k-means
+      cluster centers of the samples, or "subset" for a random subset of the samples.
+    * seed: Seed for "kmeans" and "subset".
+    '''
+    X = np.asarray(X, dtype=float)
+    amt = max(min(amt, len(X)), 1)
+    if placement == "grid":
+        per_axis = max(int(math.ceil(amt ** (1 / X.shape[1]))), 1)
+        axes = [np.linspace(lo, hi, per_axis) for lo, hi in zip(X.min(axis=0), X.max(axis=0))]
+        grids = np.meshgrid(*axes, indexing="ij")
+        return np.stack([g.ravel() for g in grids], axis=1)
+    elif placement == "kmeans":
+        centers, _ = kmeans2(X, amt, minit="++", seed=seed)
+        return centers
+    elif placement == "subset":
+        rng = np.random.default_rng(seed)
+        return X[np.sort(rng.choice(len(X), amt, replace=False))]
+    raise ValueError(f"Unknown inducing point placement: {placement}")
 
 
 class Model(object):
     '''
     A wrapper for the GPy model.
     '''
-    def __init__(self, d3=False):
+    # Optimized lengthscales below this are treated as collapsed, and aren't used for warm starts.
+    min_lengthscale = 1e-3
+    # Fits on fewer samples than this are too loosely constrained to warm-start from.
+    min_warm_samples = 10
+
+    def __init__(self, d3=False, predict_budget=64 * 1024 * 1024, refit_interval=1, refit_drift=None,
+                 optimizer="lbfgsb", max_iters=1000, warm_start=True,
+                 rmse_cells=0, rmse_stride=1, rmse_seed=0,
+                 sparse=False, sparse_threshold=0, inducing=100, inducing_placement="kmeans",
+                 cache_bytes=256 * 1024 * 1024, telemetry=None, adaptive=0, adaptive_tol=0.05):
         '''
         Creates a new model.
 
         Args:
         * d3: Whether this is a 3D model.
+        * predict_budget: Approximate amount of memory, in bytes, that a single batched GPy
+          prediction call may use. Larger regions are predicted in chunks.
+        * refit_interval: Samples between full rebuilds (and hyperparameter optimizations) of the
+          regression. In between, samples are added to the posterior incrementally. 1 rebuilds on
+          every sample; 0 only rebuilds when refit_drift is exceeded.
+        * refit_drift: If set, also rebuild when the per-sample log likelihood of the incremental
+          posterior drifts by more than this from its value at the last rebuild.
+        * optimizer: Name of the paramz optimizer used for hyperparameters (ex. "lbfgsb", "scg", "bfgs").
+        * max_iters: Iteration cap for each hyperparameter optimization.
+        * warm_start: Whether each rebuild starts from the last optimized hyperparameters instead of
+          the kernel defaults.
+        * rmse_cells: If above 0, RMSE is estimated from this many randomly chosen cells instead of
+          every cell. The same cells are used every time for a given region.
+        * rmse_stride: If above 1, RMSE is estimated on a lattice with this spacing.
+        * rmse_seed: Seed used to choose the RMSE cells.
+        * sparse: Whether to use a sparse GP with inducing points instead of an exact GP.
+        * sparse_threshold: If above 0, switch to a sparse GP once there are this many samples.
+        * inducing: Amount of inducing points for the sparse GP.
+        * inducing_placement: How inducing points are placed. See inducing_points().
+        * cache_bytes: Memory bound for cached predictions.
+        * telemetry: A telemetry.Telemetry sink for RMSE, sample and timing events. If None,
+          RMSE logs are printed.
+        * adaptive: If above 0, robots choose points from adaptive predictions, refined from tiles this
+          many cells wide, instead of predicting every cell. See predict_target().
+        * adaptive_tol: Tolerance of adaptive predictions. See adaptive.AdaptivePrediction.
         '''
         self.input = []
         self.output = []
         # Cached versions of the GP model as well as posterior mean & variance,
         # so we don't have to recalculate them multiple times per iteration.
         self.__regression = None
-        self.__predictions = None
+        self.__posterior = None
+        self.predictions = PredictionCache(cache_bytes)
+        # Incremented whenever predictions would change, so that cached ones aren't reused.
+        self.version = 0
         self.d3 = d3
+        self.predict_budget = predict_budget
+        self.refit_interval = refit_interval
+        self.refit_drift = refit_drift
+        # Samples added since the last rebuild, the per-sample log likelihood at that rebuild, and the
+        # amount of samples it was on.
+        self.__since_refit = 0
+        self.__base_ll = None
+        self.__fit_samples = 0
+        self.optimizer = optimizer
+        self.max_iters = max_iters
+        self.warm_start = warm_start
+        # Last optimized kernel variance, lengthscale and noise variance, or None before the first fit.
+        self.hyperparameters = None
+        # One entry per hyperparameter optimization: sample count, wall time (s) and function evaluations.
+        self.opt_log = []
+        self.rmse_cells = rmse_cells
+        self.rmse_stride = rmse_stride
+        self.rmse_seed = rmse_seed
+        self.__rmse_indices = {}
+        self.sparse = sparse
+        self.sparse_threshold = sparse_threshold
+        self.inducing = inducing
+        self.inducing_placement = inducing_placement
+        # Whether the current regression is sparse
+        self.__sparse_fit = False
         self.rmse_log = []
+        # 95% confidence half-width of each logged RMSE; 0 when every cell was used.
+        self.rmse_bounds = []
+        self.telemetry = telemetry
+        # Times refits and predictions. Robots replace it with their own to get per-robot totals.
+        self.timer = Timer()
+        self.adaptive = adaptive
+        self.adaptive_tol = adaptive_tol
+
+    @property
+    def incremental(self):
+        '''
+        Whether samples are added to the posterior without a full rebuild.
+        '''
+        return self.refit_interval != 1
+
+    @property
+    def uses_sparse(self):
+        '''
+        Whether the regression for the current sample set should be a sparse GP.
+        '''
+        return self.sparse or 0 < self.sparse_threshold <= len(self.input)
 
     def sample(self, pos, val):
         '''
         Adds a sample to the model.
         '''
-        if self.d3:
-            self.input.append([pos.x, pos.y, pos.z])
-        else:
-            self.input.append([pos.x, pos.z])
-        self.output.append([val])
+        self.sample_many([(pos, val)])
+
+    def sample_many(self, samples):
+        '''
+        Adds a list of (position, value) samples to the model as a single update, so that the model
+        version changes once and, in incremental mode, a sparse fit is updated once.
+        '''
+        if len(samples) == 0:
+            return
+        self.append(samples)
+        if self.__regression is None:
+            return
+        # A fit on only a few samples can be degenerate (see __fit()), so it's rebuilt instead of being
+        # updated until it has enough. Otherwise a TiledModel's expert that few samples reach could
+        # keep it for good.
+        if not self.incremental or self.__sparse_fit != self.uses_sparse or \
+                self.__fit_samples < self.min_warm_samples:
+            self.invalidate()
+            return
+        with self.timer.phase("refit"):
+            if self.__posterior is not None:
+                for i in range(len(self.input) - len(samples), len(self.input)):
+                    self.__posterior.append(self.input[i], self.output[i][0])
+                ll = self.__posterior.log_likelihood()
+            else:
+                # Sparse fits keep their inducing points and hyperparameters, so this is only O(n m^2).
+                self.__regression.set_XY(np.array(self.input), np.array(self.output))
+                ll = np.asarray(self.__regression.log_likelihood()).item()
+        self.__since_refit += len(samples)
+        if self.refit_interval > 0 and self.__since_refit >= self.refit_interval:
+            self.invalidate()
+        elif self.refit_drift is not None:
+            if abs(ll / len(self.input) - self.__base_ll) > self.refit_drift:
+                self.invalidate()
+
+    def close(self):
+        '''
+        Releases anything the model holds besides memory, ex. a TiledModel's process pool.
+        '''
+        pass
+
+    def append(self, samples):
+        '''
+        Adds a list of (position, value) samples to self.input and self.output, and changes the model
+        version, without updating the regression. See sample_many().
+        '''
+        for pos, val in samples:
+            if self.d3:
+                self.input.append([pos.x, pos.y, pos.z])
+            else:
+                self.input.append([pos.x, pos.z])
+            self.output.append([val])
+            if self.telemetry is not None:
+                self.telemetry.event("sample", samples=len(self.input), x=pos.x, y=pos.y, z=pos.z, value=val)
+        self.version += 1
+
+    @property
+    def fitted(self):
+        '''
+        Whether the regression is built, so that using it won't refit.
+        '''
+        return self.__regression is not None
+
+    def invalidate(self):
+        '''
+        Drops the regression, so that it's rebuilt and reoptimized on next use.
+        '''
         self.__regression = None
-        self.__predictions = None
+        self.__posterior = None
+        self.version += 1
 
-    def rmse(self, grid, rgn=None):
+    def state(self):
+        '''
+        The model's samples, last optimized hyperparameters and logs, as a dict of plain Python
+        values that can be saved as JSON. See load_state().
+        '''
+        return {
+            "input": [[float(v) for v in p] for p in self.input],
+            "output": [[float(v[0])] for v in self.output],
+            "hyperparameters": self.hyperparameters,
+            "opt_log": self.opt_log,
+            "rmse_log": self.rmse_log,
+            "rmse_bounds": self.rmse_bounds,
+        }
+
+    def load_state(self, state):
+        '''
+        Replaces the model's samples, hyperparameters and logs with ones from state(). The regression
+        is rebuilt on next use, warm-started from the loaded hyperparameters if warm_start is set.
+        '''
+        self.input = [list(p) for p in state["input"]]
+        self.output = [list(v) for v in state["output"]]
+        self.hyperparameters = state["hyperparameters"]
+        self.opt_log = list(state["opt_log"])
+        self.rmse_log = list(state["rmse_log"])
+        self.rmse_bounds = list(state["rmse_bounds"])
+        self.invalidate()
+
+    def rmse_indices(self, rgn):
         '''
-        Calculates RMSE between the model and a grid.
+        Indices into a prediction of rgn of the cells used to estimate RMSE, as an (N, dims) array,
+        or None if every cell is used.
+        '''
+        if self.rmse_cells <= 0 and self.rmse_stride <= 1:
+            return None
+        if rgn not in self.__rmse_indices:
+            axes = [np.arange(0, n, max(self.rmse_stride, 1)) for n in rgn.shape(self.d3)]
+            grids = np.meshgrid(*axes, indexing="ij")
+            indices = np.stack([g.ravel() for g in grids], axis=1)
+            if 0 < self.rmse_cells < len(indices):
+                rng = np.random.default_rng(self.rmse_seed)
+                indices = indices[np.sort(rng.choice(len(indices), self.rmse_cells, replace=False))]
+            self.__rmse_indices[rgn] = indices
+        return self.__rmse_indices[rgn]
+
+    def estimate_rmse(self, grid, rgn=None):
+        '''
+        Calculates RMSE between the model and a grid, using the cells from self.rmse_indices().
+        Returns the RMSE and the half-width of its approximate 95% confidence interval, which is 0
+        if every cell was used.
 
         Args:
         * grid: The grid to which to compare the model.
@@ -131,33 +423,46 @@ class Model(object):
         '''
         if rgn is None:
             rgn = Region((0, 0, 0), grid.size)
-        pred = self.predict(rgn)
-        acc = 0
-        num = 0
-        if self.d3:
-            for x in range(rgn.a.x, rgn.b.x):
-                for y in range(rgn.a.y, rgn.b.y):
-                    for z in range(rgn.a.z, rgn.b.z):
-                        p = pred.mean[x][y][z][1]
-                        o = grid[Vector(x, y, z)]
-                        acc += (p - o)**2
-                        num += 1
+        truth = grid.sample_rgn(rgn)
+        indices = self.rmse_indices(rgn)
+        if indices is None:
+            pred = self.predict(rgn, "mean")
+            return math.sqrt(np.mean((pred.mean - truth)**2)), 0
+        cells = tuple(indices.T)
+        pred = self.predictions.get(rgn, self.version, self.d3)
+        if pred is not None:
+            mean = pred.mean[cells]
         else:
-            for x in range(rgn.a.x, rgn.b.x):
-                xi = x - rgn.a.x
-                for z in range(rgn.a.z, rgn.b.z):
-                    p = pred.mean[xi][z - rgn.a.z][1]
-                    o = grid[Vector(x, 0, z)]
-                    acc += (p - o)**2
-                    num += 1
-        return math.sqrt(acc / num)
+            offset = [rgn.a.x, rgn.a.y, rgn.a.z] if self.d3 else [rgn.a.x, rgn.a.z]
+            mean, _ = self.predict_lattice(indices + np.array(offset), "mean")
+        err = (mean - truth[cells])**2
+        mse = err.mean()
+        if len(err) < 2 or mse == 0:
+            return math.sqrt(mse), 0
+        # Standard error of the mean squared error, with the finite population correction,
+        # carried through the square root with the delta method.
+        se = err.std(ddof=1) / math.sqrt(len(err)) * math.sqrt(1 - len(err) / truth.size)
+        return math.sqrt(mse), float(1.96 * se / (2 * math.sqrt(mse)))
+
+    def rmse(self, grid, rgn=None):
+        '''
+        Calculates RMSE between the model and a grid. See estimate_rmse().
+        '''
+        return self.estimate_rmse(grid, rgn)[0]
 
     def log_rmse(self, grid, rgn=None):
         '''
         Gets the current RMSE and adds it to the RMSE log.
         '''
-        self.rmse_log.append(self.rmse(grid, rgn))
-        print(f"RMSE {len(self.rmse_log)}: {self.rmse_log[-1]}")
+        rmse, bound = self.estimate_rmse(grid, rgn)
+        self.rmse_log.append(rmse)
+        self.rmse_bounds.append(bound)
+        if self.telemetry is not None:
+            self.telemetry.event("rmse", samples=len(self.input), rmse=rmse, bound=bound)
+        elif bound > 0:
+            print(f"RMSE {len(self.rmse_log)}: {rmse} ± {bound}")
+        else:
+            print(f"RMSE {len(self.rmse_log)}: {rmse}")
 
     @property
     def dims(self):
@@ -172,56 +477,194 @@ class Model(object):
     @property
     def regression(self):
         '''
-        Gets the GPy regression for the current sample set.
+        Gets the GPy regression for the current sample set. In incremental mode, an exact
+        regression is the one from the last rebuild, and may not include the latest samples.
         '''
         if self.__regression is None:
-            self.__regression = gp.models.GPRegression(np.array(self.input), np.array(self.output),
-                                                       gp.kern.Exponential(self.dims))
-            # Optimization seems to give better results.
-            self.__regression.optimize()
+            with self.timer.phase("refit"):
+                self.__fit()
         return self.__regression
 
-    def predict(self, rgn):
+    def __fit(self):
         '''
-        Generates a Prediction for points in rgn.
+        Builds the regression and optimizes its hyperparameters.
         '''
+        if self.warm_start and self.hyperparameters is not None:
+            kern = gp.kern.Exponential(self.dims, variance=self.hyperparameters["variance"],
+                                       lengthscale=self.hyperparameters["lengthscale"])
+            noise = self.hyperparameters["noise"]
+        else:
+            kern = gp.kern.Exponential(self.dims)
+            noise = 1.0
+        X = np.array(self.input)
+        Y = np.array(self.output)
+        self.__fit_samples = len(self.input)
+        self.__sparse_fit = self.uses_sparse
+        if self.__sparse_fit:
+            Z = inducing_points(X, self.inducing, self.inducing_placement)
+            self.__regression = gp.models.SparseGPRegression(X, Y, kern, Z=Z)
+            self.__regression.likelihood.variance = noise
+            # Keeping the inducing points where they were placed makes optimization much cheaper.
+            self.__regression.inducing_inputs.fix()
+        else:
+            self.__regression = gp.models.GPRegression(X, Y, kern, noise_var=noise)
+        # Optimization seems to give better results.
+        start = time.perf_counter()
+        self.__regression.optimize(optimizer=self.optimizer, max_iters=self.max_iters)
+        self.opt_log.append({
+            "samples": len(self.input),
+            "time": time.perf_counter() - start,
+            "evaluations": self.__regression.optimization_runs[-1].funct_eval,
+        })
+        if self.telemetry is not None:
+            self.telemetry.event("timing", name="optimize", samples=len(self.input),
+                                 seconds=self.opt_log[-1]["time"])
+        lengthscale = float(self.__regression.kern.lengthscale[0])
+        if lengthscale < self.min_lengthscale or len(self.input) < self.min_warm_samples:
+            # With few samples, the optimizer sometimes collapses the lengthscale to a white noise
+            # fit, or blows it up to a near-constant one. The gradient vanishes at both, so warm
+            # starts from them would never recover.
+            self.hyperparameters = None
+        else:
+            self.hyperparameters = {
+                "variance": float(self.__regression.kern.variance[0]),
+                "lengthscale": lengthscale,
+                "noise": float(self.__regression.likelihood.variance[0]),
+            }
+        if self.incremental:
+            if not self.__sparse_fit:
+                self.__posterior = IncrementalPosterior(self.__regression.kern,
+                                                        self.__regression.likelihood.variance[0],
+                                                        self.input, self.output)
+            self.__since_refit = 0
+            self.__base_ll = np.asarray(self.__regression.log_likelihood()).item() / len(self.input)
 
-        if self.__predictions is None or rgn not in self.__predictions:
-            if self.__predictions is None:
-                self.__predictions = {}
+    def fantasy(self):
+        '''
+        An IncrementalPosterior over the current samples with the current hyperparameters, which
+        fantasized samples can be added to without changing the model. With a sparse fit, this is an
+        exact posterior with the sparse fit's hyperparameters.
+        '''
+        regression = self.regression
+        if self.__posterior is not None:
+            # append() replaces the arrays instead of changing them, so a shallow copy is independent.
+            return copy.copy(self.__posterior)
+        return IncrementalPosterior(regression.kern, regression.likelihood.variance[0], self.input, self.output)
+
+    def predict_points(self, points, outputs="both"):
+        '''
+        Predicts the noiseless posterior mean & variance at an (N, dims) array of points.
+        Returns two (N, 1) arrays. If outputs is "mean" or "var", the other may be None.
+        '''
+        regression = self.regression
+        if self.__posterior is not None:
+            return self.__posterior.predict_noiseless(points, outputs)
+        if outputs == "mean":
+            # The mean alone doesn't need the O(n^2) per point variance term.
+            inputs = regression.Z if self.__sparse_fit else regression.X
+            return regression.kern.K(points, np.asarray(inputs)).dot(regression.posterior.woodbury_vector), None
+        return regression.predict_noiseless(points)
+
+    @property
+    def chunk_size(self):
+        '''
+        Amount of points to predict per GPy call. GPy builds a (chunk x samples) cross-covariance
+        matrix, along with a few temporaries of the same size, so the chunk shrinks as samples grow.
+        '''
+        per_point = 8 * 4 * max(len(self.input), 1)
+        return max(1, self.predict_budget // per_point)
+
+    def predict_lattice(self, points, outputs="both"):
+        '''
+        Predicts the posterior mean & variance at an (N, dims) array of points, in chunks of
+        self.chunk_size. Returns two flat arrays, or None in place of an output that wasn't
+        asked for ("mean", "var" or "both").
+        '''
+        start = time.perf_counter()
+        p_mean = np.empty(len(points)) if outputs != "var" else None
+        p_var = np.empty(len(points)) if outputs != "mean" else None
+        with self.timer.phase("predict"):
+            self.__predict_chunks(points, outputs, p_mean, p_var)
+        if self.telemetry is not None:
+            self.telemetry.event("timing", name=f"predict_{outputs}", samples=len(self.input),
+                                 value=len(points), seconds=time.perf_counter() - start)
+        return p_mean, p_var
+
+    def __predict_chunks(self, points, outputs, p_mean, p_var):
+        '''
+        Predicts points in chunks of self.chunk_size, writing into the flat arrays p_mean and p_var.
+        '''
+        chunk = self.chunk_size
+        for i in range(0, len(points), chunk):
+            mean, var = self.predict_points(points[i:i + chunk], outputs)
+            if p_mean is not None:
+                p_mean[i:i + chunk] = mean[:, 0]
+            if p_var is not None:
+                p_var[i:i + chunk] = var[:, 0]
+
+    def predict_region(self, rgn, outputs="both"):
+        '''
+        Predicts every point of rgn. Returns two arrays shaped rgn.shape(self.d3), or None in place
+        of an output that wasn't asked for.
+
+        The lattice is built one slab of x layers at a time, each about self.chunk_size points, so
+        memory use beyond the outputs stays bounded even for large volumes.
+        '''
+        start = time.perf_counter()
+        shape = rgn.shape(self.d3)
+        p_mean = np.empty(shape) if outputs != "var" else None
+        p_var = np.empty(shape) if outputs != "mean" else None
+        layer = int(np.prod(shape[1:]))
+        slab = max(1, self.chunk_size // max(layer, 1))
+        with self.timer.phase("predict"):
+            for x in range(0, shape[0], slab):
+                n = min(slab, shape[0] - x)
+                sub = Region((rgn.a.x + x, rgn.a.y, rgn.a.z), (rgn.a.x + x + n, rgn.b.y, rgn.b.z))
+                # Slices along the first axis of a C-ordered array are contiguous, so these are views.
+                self.__predict_chunks(sub.lattice(self.d3), outputs,
+                                      None if p_mean is None else p_mean[x:x + n].reshape(-1),
+                                      None if p_var is None else p_var[x:x + n].reshape(-1))
+        if self.telemetry is not None:
+            self.telemetry.event("timing", name=f"predict_{outputs}", samples=len(self.input),
+                                 value=int(np.prod(shape)), seconds=time.perf_counter() - start)
+        return p_mean, p_var
+
+    def predict(self, rgn, outputs="both"):
+        '''
+        Generates a Prediction for points in rgn.
+
+        Args:
+        * rgn: The region to predict.
+        * outputs: "mean", "var" or "both". These are computed right away, in one pass. The
+          others are computed if and when they're first used.
+        '''
+        pred = self.predictions.get(rgn, self.version, self.d3)
+        if pred is None:
             # I couldn't find a method in GPy that gives the derivative function,
-            # so I'm just getting the posterior mean & variance at every point,
-            # because it's fast enough to be usable and it seems like it's more
-            # prudent to spend my time on other parts of the program.
-            p_mean = []
-            p_var = []
+            # so I'm just getting the posterior mean & variance at every point.
+            # The region is predicted slab by slab, in chunks, to bound memory use.
+            version = self.version
 
-            # Transforming the data into 2D arrays, so they can be displayed by matplotlib
-            if self.d3:
-                for x in range(rgn.a.x, rgn.b.x):
-                    p_mean.append([])
-                    p_var.append([])
-                    for y in range(rgn.a.y, max(rgn.b.y, 1)):
-                        p_mean[x - rgn.a.x].append([])
-                        p_var[x - rgn.a.x].append([])
-                        for z in range(rgn.a.z, rgn.b.z):
-                            mean, var = self.regression.predict_noiseless(np.array([[x, y, z]]))
-                            mean = mean[0][0]
-                            var = var[0][0]
-                            pos = Vector(x, y, z)
-                            p_mean[x - rgn.a.x][y - rgn.a.y].append([pos, mean])
-                            p_var[x - rgn.a.x][y - rgn.a.y].append([pos, var])
-            else:
-                for x in range(rgn.a.x, rgn.b.x):
-                    p_mean.append([])
-                    p_var.append([])
-                    xi = x - rgn.a.x
-                    for z in range(rgn.a.z, rgn.b.z):
-                        mean, var = self.regression.predict_noiseless(np.array([[x, z]]))
-                        mean = mean[0][0]
-                        var = var[0][0]
-                        pos = Vector(x, 0, z)
-                        p_mean[xi].append([pos, mean])
-                        p_var[xi].append([pos, var])
-            self.__predictions[rgn] = Prediction(p_mean, p_var, self.d3)
-        return self.__predictions[rgn]
\ No newline at end of file
+            def source(which):
+                if self.version != version:
+                    raise RuntimeError(f"Can't compute {which} of a prediction made before the model changed.")
+                return self.predict_region(rgn, which)[0 if which == "mean" else 1]
+
+            p_mean, p_var = self.predict_region(rgn, outputs)
+            pred = Prediction(rgn, p_mean, p_var, self.d3, source)
+            self.predictions.put(self.version, pred)
+        return pred
+
+    def predict_target(self, rgn, target="var"):
+        '''
+        Predicts rgn for finding the highest (or lowest) value of target, "mean" or "var". If self.adaptive
+        is set, this is an adaptive.AdaptivePrediction, which only predicts every cell around the
+        extremes of target and where the posterior changes sharply. Otherwise, it's predict(rgn, target).
+        '''
+        if self.adaptive <= 0:
+            return self.predict(rgn, target)
+        pred = self.predictions.get(rgn, self.version, self.d3)
+        if pred is not None:
+            return pred
+        return AdaptivePrediction(rgn, self.predict_lattice, self.d3, target,
+                                  self.adaptive, self.adaptive_tol, samples=np.array(self.input).reshape(-1, self.dims))
@@ -0,0 +1,100 @@
+'''
+Batch destination choice for UGVs, so that the model is refit once per batch of destinations
+instead of once per sample.
+'''
+
+import math
+import numpy as np
+from scipy.linalg import solve_triangular
+
+from model import *
+from acquisition import *
+
+
+def path(start, dest, move_range):
+    '''
+    The positions at which a robot moving from start to dest by move_range at a time takes samples,
+    ending with dest. See Robot.move_towards_dest().
+    '''
+    if start == dest:
+        return [dest]
+    res = []
+    pos = start
+    while pos != dest:
+        dir_vec = dest - pos
+        if dir_vec.length() <= move_range:
+            pos = dest
+        else:
+            pos = pos + dir_vec.norm() * move_range
+        res.append(pos)
+    return res
+
+
+class BatchPlanner(object):
+    '''
+    Chooses several destinations at once, each the candidate point with the highest predicted variance
+    given fantasized samples along the path to every destination chosen before it.
+
+    The fantasized samples take the posterior mean as their value. The posterior variance doesn't depend
+    on sample values, so with the model's hyperparameters, the variances are exactly the ones the model
+    will have once the real samples are added.
+    '''
+    def __init__(self, model, rgn, batch, move_range, lattice_points=0):
+        '''
+        Create a new batch planner.
+
+        Args:
+        * model: The Model to plan with.
+        * rgn: Region in which to choose points.
+        * batch: Amount of destinations to choose at once.
+        * move_range: Movement radius of the robot, which determines where it takes samples along its path.
+        * lattice_points: If above 0, candidates are a lattice of about this many points over rgn,
+          including its far edges. Otherwise, they're every integer point of rgn.
+        '''
+        assert(batch > 0)
+        self.model = model
+        self.rgn = rgn
+        self.batch = batch
+        self.move_range = move_range
+        shape = rgn.shape(model.d3)
+        cells = int(np.prod(shape))
+        spacing = 1
+        if 0 < lattice_points < cells:
+            axes = sum(1 for n in shape if n > 1)
+            spacing = max(1, int(math.ceil((cells / lattice_points) ** (1 / max(axes, 1)))))
+        lo = [rgn.a.x, rgn.a.y, rgn.a.z] if model.d3 else [rgn.a.x, rgn.a.z]
+        grids = np.meshgrid(*[lattice_axis(a, a + n, spacing) for a, n in zip(lo, shape)], indexing="ij")
+        self.candidates = np.stack([g.ravel() for g in grids], axis=1).astype(float)
+
+    def __point(self, pos):
+        return [pos.x, pos.y, pos.z] if self.model.d3 else [pos.x, pos.z]
+
+    def __position(self, point):
+        if self.model.d3:
+            return Vector(int(point[0]), int(point[1]), int(point[2]))
+        return Vector(int(point[0]), 0, int(point[1]))
+
+    def plan(self, pos):
+        '''
+        Chooses self.batch destinations for a robot at pos, in the order it should visit them.
+        '''
+        posterior = self.model.fantasy()
+        C = self.candidates
+        kern = posterior.kern
+        # Rows of L^-1 K(X, C), extended by a row for each fantasized sample, so that the variance at
+        # the candidates drops by the square of each new row.
+        A = solve_triangular(posterior.L, kern.K(posterior.X, C), lower=True)
+        var = kern.Kdiag(C) - np.einsum("ij,ij->j", A, A)
+        res = []
+        start = pos
+        for i in range(self.batch):
+            dest = self.__position(C[np.argmax(var)])
+            for p in path(start, dest, self.move_range):
+                x = np.array([self.__point(p)], dtype=float)
+                l, d = posterior.append(x)
+                row = (kern.K(x, C)[0] - l.dot(A)) / d
+                A = np.vstack([A, row])
+                var = var - row * row
+            res.append(dest)
+            start = dest
+        return res
@@ -0,0 +1,91 @@
+import math
+import numpy as np
+from scipy.linalg import cholesky, solve_triangular
+
+
+class IncrementalPosterior(object):
+    '''
+    An exact GP posterior with fixed hyperparameters that can take new observations
+    without being rebuilt. Each new observation extends the Cholesky factor of
+    K + noise * I by one row, which is O(n^2) instead of the O(n^3) of a full refactorization.
+    '''
+    # Added to the diagonal so duplicate sample positions don't make the factor singular.
+    jitter = 1e-8
+
+    def __init__(self, kern, noise, X, Y):
+        '''
+        Creates a posterior from an initial set of observations.
+
+        Args:
+        * kern: A GPy kernel with the hyperparameters to use.
+        * noise: Gaussian noise variance of the observations.
+        * X: (N, D) array of observation positions.
+        * Y: (N, 1) array of observed values.
+        '''
+        self.kern = kern
+        self.noise = float(noise)
+        self.X = np.array(X, dtype=float)
+        self.Y = np.array(Y, dtype=float).reshape(-1)
+        K = self.kern.K(self.X) + (self.noise + self.jitter) * np.eye(len(self.X))
+        self.L = cholesky(K, lower=True)
+        # v = L^-1 y, so that the posterior mean is k*^T L^-T v
+        self.v = solve_triangular(self.L, self.Y, lower=True)
+        self.__alpha = None
+
+    def __len__(self):
+        return len(self.Y)
+
+    def append(self, x, y=None):
+        '''
+        Adds one observation, extending the Cholesky factor by a single row. Returns the new row,
+        as L^-1 k(X, x) and its diagonal entry.
+
+        If y is None, the observation is fantasized at the posterior mean, which leaves the mean as it
+        was but lowers the variance around x, as a real observation would.
+        '''
+        x = np.array(x, dtype=float).reshape(1, -1)
+        k = self.kern.K(self.X, x)[:, 0]
+        c = self.kern.Kdiag(x)[0] + self.noise + self.jitter
+        l = solve_triangular(self.L, k, lower=True)
+        d = math.sqrt(max(c - l.dot(l), self.jitter))
+        if y is None:
+            y = l.dot(self.v)
+        n = len(self.Y)
+        L = np.zeros((n + 1, n + 1))
+        L[:n, :n] = self.L
+        L[n, :n] = l
+        L[n, n] = d
+        self.L = L
+        self.v = np.append(self.v, (y - l.dot(self.v)) / d)
+        self.X = np.vstack([self.X, x])
+        self.Y = np.append(self.Y, y)
+        self.__alpha = None
+        return l, d
+
+    @property
+    def alpha(self):
+        '''
+        (K + noise * I)^-1 y, so that the posterior mean is k*^T alpha.
+        '''
+        if self.__alpha is None:
+            self.__alpha = solve_triangular(self.L.T, self.v, lower=False)
+        return self.__alpha
+
+    def log_likelihood(self):
+        '''
+        Log marginal likelihood of the observations under the current hyperparameters.
+        '''
+        n = len(self.Y)
+        return -0.5 * self.v.dot(self.v) - np.log(np.diag(self.L)).sum() - 0.5 * n * math.log(2 * math.pi)
+
+    def predict_noiseless(self, points, outputs="both"):
+        '''
+        Posterior mean and variance at an (N, D) array of points, shaped (N, 1) like GPy's output.
+        If outputs is "mean", only the mean is computed, and None is returned for the variance.
+        '''
+        if outputs == "mean":
+            return self.kern.K(points, self.X).dot(self.alpha)[:, None], None
+        A = solve_triangular(self.L, self.kern.K(self.X, points), lower=True)
+        mean = A.T.dot(self.v)
+        var = np.maximum(self.kern.Kdiag(points) - np.einsum("ij,ij->j", A, A), 0)
+        return mean[:, None], var[:, None]
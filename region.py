@@ -1,3 +1,5 @@
+import hashlib
+import json
 import math
 import numpy as np
 from util import *
@@ -6,41 +8,157 @@ class Map(object):
     '''
     A WiFi map.
     '''
+    # Approximate amount of points in each slab of the lattice when computing the field.
+    slab_points = 1 << 16
+
     def __init__(self,
         freq=2.4, power=20,
         trans_gain=0, recv_gain=0,
         size=(24, 24, 24), src_amt=1,
         shadow_dev=2, path_loss=3,
+        seed=None,
         ):
         '''
         Creates a new WiFi map.
 
         Args:
-        * src_amt: Amount of signal sources.
+        * src_amt: Amount of signal sources. In 3D, they can be at any height.
+        * seed: Seed for the source positions and shadowing noise. Anything accepted by
+          numpy.random.default_rng(), including a Generator, which is then used directly.
         * Everything else: Parameters for wifi signal strength equation.
         '''
 
+        self.rng = np.random.default_rng(seed)
         self.srcs = []
         for i in range(src_amt):
-            self.srcs.append(
-                Vector(
-                    np.random.randint(0, size[0]),
-                    0,
-                    np.random.randint(0, size[2])
-                )
-            )
+            x = int(self.rng.integers(0, size[0]))
+            y = int(self.rng.integers(0, size[1])) if size[1] > 0 else 0
+            z = int(self.rng.integers(0, size[2]))
+            self.srcs.append(Vector(x, y, z))
 
         self.rss0 = power + trans_gain + recv_gain + 20 * math.log10(3 / (4 * math.pi * freq * 10))
         self.path_loss = path_loss
         self.shadow_dev = shadow_dev
+        # Samples taken off of the integer lattice covered by self.field
         self.cache = {}
         self.size = size
+        self.__field = None
+        # The field's noise is drawn from its own stream, far ahead of self.rng's, so that it doesn't
+        # depend on when the field is first needed. With the other parameters, its state determines the field.
+        self.field_state = self.rng.bit_generator.jumped().state
+
+    @property
+    def d3(self):
+        return self.size[1] > 0
+
+    @property
+    def region(self):
+        '''
+        The Region covered by the map.
+        '''
+        return Region((0, 0, 0), self.size)
+
+    @property
+    def field(self):
+        '''
+        The ground truth RSS at every integer point of the map, shaped self.region.shape(self.d3).
+        Computed the first time it's needed, one pass over the sources, one slab of x layers at a
+        time so that volumes don't need their whole lattice in memory.
+        '''
+        if self.__field is None:
+            bits = type(self.rng.bit_generator)()
+            bits.state = self.field_state
+            rng = np.random.Generator(bits)
+            shape = self.region.shape(self.d3)
+            field = np.zeros(shape)
+            slab = max(1, self.slab_points // int(np.prod(shape[1:])))
+            for src in self.srcs:
+                for x in range(0, shape[0], slab):
+                    n = min(slab, shape[0] - x)
+                    points = Region((x, 0, 0), (x + n, self.size[1], self.size[2])).lattice(self.d3)
+                    if not self.d3:
+                        points = np.insert(points, 1, 0, axis=1)
+                    dist = Vectors(points).distance(src)
+                    at_src = dist == 0
+                    noise = rng.normal(0, self.shadow_dev, len(points))
+                    with np.errstate(divide="ignore"):
+                        field[x:x + n] += np.where(at_src, self.rss0,
+                                                   self.rss0 - (10 * self.path_loss * np.log10(dist)) + noise
+                                                   ).reshape((n,) + shape[1:])
+            self.__field = field
+        return self.__field
+
+    @property
+    def has_field(self):
+        '''
+        Whether the field was computed (or set) yet.
+        '''
+        return self.__field is not None
+
+    def key(self):
+        '''
+        A hash of everything that determines the map's ground truth, for caching it.
+        '''
+        desc = {
+            "size": list(self.size),
+            "srcs": [list(src) for src in self.srcs],
+            "rss0": self.rss0,
+            "path_loss": self.path_loss,
+            "shadow_dev": self.shadow_dev,
+            "rng": self.field_state,
+        }
+        return hashlib.sha256(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+    def set_field(self, field):
+        '''
+        Uses a field computed earlier, ex. a memory-mapped one from a cache, instead of computing it.
+        '''
+        assert(field.shape == self.region.shape(self.d3))
+        self.__field = field
+
+    def state(self):
+        '''
+        The state of the map's random numbers and off-lattice samples, as a dict of plain Python values.
+        Together with the field, it's everything that a simulation changes. See load_state().
+        '''
+        return {
+            "rng": self.rng.bit_generator.state,
+            "cache": [[pos.x, pos.y, pos.z, float(val)] for pos, val in self.cache.items()],
+        }
+
+    def load_state(self, state):
+        '''
+        Restores the map's random numbers and off-lattice samples from state().
+        '''
+        self.rng.bit_generator.state = state["rng"]
+        self.cache = {Vector(x, y, z): val for x, y, z, val in state["cache"]}
+
+    def index(self, pos):
+        '''
+        The index of pos in self.field, or None if pos isn't an integer point in the map.
+        '''
+        if not (pos.x == int(pos.x) and pos.y == int(pos.y) and pos.z == int(pos.z)):
+            return None
+        shape = self.region.shape(self.d3)
+        if self.d3:
+            index = (int(pos.x), int(pos.y), int(pos.z))
+        elif pos.y == 0:
+            index = (int(pos.x), int(pos.z))
+        else:
+            return None
+        for i, n in zip(index, shape):
+            if not 0 <= i < n:
+                return None
+        return index
 
     def sample(self, pos):
         '''
         Takes a sample from the grid. This is cached so that all samples at a given position
         have the same error.
         '''
+        index = self.index(pos)
+        if index is not None:
+            return self.field[index]
         if pos in self.cache:
             return self.cache[pos]
         val = 0
@@ -50,31 +168,20 @@ class Map(object):
             else:
                 dist = pos.distance(src)
                 val += self.rss0 - (10 * self.path_loss * math.log10(dist)) \
-                    + np.random.normal(0, self.shadow_dev)
+                    + self.rng.normal(0, self.shadow_dev)
         self.cache[pos] = val
         return val
 
     def sample_rgn(self, rgn):
         '''
-        Runs self.sample() for every point in a Region.
-        '''
-        res = []
-        if rgn.b.y > 0:
-            for x in range(rgn.a.x, rgn.b.x):
-                res.append([])
-                xi = x - rgn.a.x
-                for y in range(rgn.a.y, rgn.b.y):
-                    res[xi].append([])
-                    yi = y - rgn.a.y
-                    for z in range(rgn.a.z, rgn.b.z):
-                        rgn[xi][yi].append(self.sample(Vector(x, y, z)))
+        Gets the ground truth for every integer point in a Region, as an array shaped rgn.shape(self.d3).
+        The region must be inside the map.
+        '''
+        shape = rgn.shape(self.d3)
+        if self.d3:
+            return self.field[rgn.a.x:rgn.a.x + shape[0], rgn.a.y:rgn.a.y + shape[1], rgn.a.z:rgn.a.z + shape[2]]
         else:
-            for x in range(rgn.a.x, rgn.b.x):
-                res.append([])
-                xi = x - rgn.a.x
-                for z in range(rgn.a.z, rgn.b.z):
-                    res[xi].append(self.sample(Vector(x, 0, z)))
-        return res
+            return self.field[rgn.a.x:rgn.a.x + shape[0], rgn.a.z:rgn.a.z + shape[1]]
 
     def __getitem__(self, item):
         return self.sample(item)
@@ -104,10 +211,60 @@ class Region(object):
         '''
         return self.a.x <= p[0] <= self.b.x and self.a.y <= p[1] <= self.b.y and self.a.z <= p[2] <= self.b.z
 
+    def contains_rgn(self, o, d3=False):
+        '''
+        Whether the lattice of o (see lattice()) is entirely inside the lattice of this region.
+        '''
+        shape = self.shape(d3)
+        o_shape = o.shape(d3)
+        if d3:
+            axes = [(self.a.x, o.a.x, 0), (self.a.y, o.a.y, 1), (self.a.z, o.a.z, 2)]
+        else:
+            axes = [(self.a.x, o.a.x, 0), (self.a.z, o.a.z, 1)]
+        for a, o_a, i in axes:
+            if o_a < a or o_a + o_shape[i] > a + shape[i]:
+                return False
+        return True
+
+    def union(self, o):
+        '''
+        The smallest region containing both this region and o.
+        '''
+        return Region(
+            (min(self.a.x, o.a.x), min(self.a.y, o.a.y), min(self.a.z, o.a.z)),
+            (max(self.b.x, o.b.x), max(self.b.y, o.b.y), max(self.b.z, o.b.z))
+        )
+
     @property
     def size(self):
         return self.b - self.a
 
+    def shape(self, d3=False):
+        '''
+        The shape of the integer lattice covering this region. In 3D, a flat region still
+        has one layer on the y axis.
+        '''
+        if d3:
+            return (self.b.x - self.a.x, max(self.b.y - self.a.y, 1), self.b.z - self.a.z)
+        else:
+            return (self.b.x - self.a.x, self.b.z - self.a.z)
+
+    def lattice(self, d3=False):
+        '''
+        Returns every integer point in the region as an (N, 2) array of [x, z] (or (N, 3) of [x, y, z],
+        if d3), ordered so that it can be reshaped to self.shape(d3).
+        '''
+        shape = self.shape(d3)
+        if d3:
+            axes = [np.arange(self.a.x, self.a.x + shape[0]),
+                    np.arange(self.a.y, self.a.y + shape[1]),
+                    np.arange(self.a.z, self.a.z + shape[2])]
+        else:
+            axes = [np.arange(self.a.x, self.a.x + shape[0]),
+                    np.arange(self.a.z, self.a.z + shape[1])]
+        grids = np.meshgrid(*axes, indexing="ij")
+        return np.stack([g.ravel() for g in grids], axis=1)
+
     def __eq__(self, o):
         return self.a == o.a and self.b == o.b
 
@@ -118,4 +275,29 @@ class Region(object):
         return f"Region({self.a}, {self.b})"
 
     def __str__(self):
-        return f"[{self.a}, {self.b}]"
\ No newline at end of file
+        return f"[{self.a}, {self.b}]"
+
+
+class LatticeValues(object):
+    '''
+    Base class for predicted means and variances at every integer point of a Region. Subclasses
+    set self.rgn and self.d3, and provide mean and var arrays shaped self.rgn.shape(self.d3).
+    '''
+    def values(self, which):
+        '''
+        Returns self.mean if which is "mean", or self.var if which is "var".
+        '''
+        if which == "mean":
+            return self.mean
+        elif which == "var":
+            return self.var
+        raise ValueError(f"Unknown prediction values: {which}")
+
+    def position(self, index):
+        '''
+        Converts an index into self.mean/self.var into an absolute position.
+        '''
+        if self.d3:
+            return Vector(self.rgn.a.x + int(index[0]), self.rgn.a.y + int(index[1]), self.rgn.a.z + int(index[2]))
+        else:
+            return Vector(self.rgn.a.x + int(index[0]), 0, self.rgn.a.z + int(index[1]))
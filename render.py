@@ -0,0 +1,132 @@
+'''
+Headless rendering of simulation frames to PNG files or an animation, in a background thread.
+'''
+
+import os
+import queue
+import threading
+import numpy as np
+
+
+class Renderer(object):
+    '''
+    Renders frames of the ground truth, predicted mean, prediction variance and RMSE log without
+    a display. One figure is built on the first frame, and later frames only update its image and
+    line data.
+
+    Frames are queued and drawn by a worker thread, so that the simulation doesn't wait on
+    matplotlib. Call close() (or use a with statement) to wait for every frame to be written.
+    '''
+    def __init__(self, path, fps=4, dpi=100, max_pending=0):
+        '''
+        Create a new renderer.
+
+        Args:
+        * path: Where to write frames. If it ends in .gif or .mp4, frames are written to that
+          animation file (.mp4 needs ffmpeg). Otherwise, it's a directory for frame_00000.png, etc.
+        * fps: Frames per second of an animation.
+        * dpi: Resolution of the frames.
+        * max_pending: If above 0, frame() waits when this many frames are waiting to be drawn,
+          to bound memory use. Otherwise, it never waits.
+        '''
+        self.path = path
+        self.fps = fps
+        self.dpi = dpi
+        self.frames = 0
+        self.animated = path.endswith(".gif") or path.endswith(".mp4")
+        if not self.animated:
+            os.makedirs(path, exist_ok=True)
+        self.__queue = queue.Queue(max_pending)
+        # Set by the worker thread if drawing fails, and raised by close()
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__work, daemon=True)
+        self.__thread.start()
+
+    def frame(self, real, mean, var, rmse_log, label=""):
+        '''
+        Queues a frame. real, mean and var are 2D arrays indexed [x, z]; they must not be changed
+        afterwards, which holds for the arrays of a Prediction. rmse_log is copied.
+        '''
+        self.__queue.put((real, mean, var, list(rmse_log), label))
+
+    def close(self):
+        '''
+        Waits for every queued frame to be written, then closes the output.
+        '''
+        self.__queue.put(None)
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __work(self):
+        '''
+        Draws queued frames until close() is called.
+        '''
+        writer = None
+        artists = None
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            if self.__error is not None:
+                continue
+            try:
+                if artists is None:
+                    artists = self.__setup(*item)
+                    if self.animated:
+                        writer = self.__writer(artists[0])
+                self.__draw(artists, *item)
+                if writer is not None:
+                    writer.grab_frame()
+                else:
+                    artists[0].savefig(os.path.join(self.path, f"frame_{self.frames:05d}.png"), dpi=self.dpi)
+                self.frames += 1
+            except Exception as e:
+                self.__error = e
+        if writer is not None:
+            writer.finish()
+
+    def __writer(self, fig):
+        from matplotlib import animation
+        if self.path.endswith(".gif"):
+            writer = animation.PillowWriter(fps=self.fps)
+        else:
+            writer = animation.FFMpegWriter(fps=self.fps)
+        writer.setup(fig, self.path, dpi=self.dpi)
+        return writer
+
+    def __setup(self, real, mean, var, rmse_log, label):
+        '''
+        Builds the figure and its artists. Returns [figure, images, RMSE line, RMSE axes, axes].
+        '''
+        # The figure is only used from this thread, and isn't attached to pyplot, so it never
+        # opens a window.
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=(8, 8))
+        FigureCanvasAgg(fig)
+        gs = fig.add_gridspec(2, 2)
+        axes = [fig.add_subplot(gs[0, 0]), fig.add_subplot(gs[0, 1]), fig.add_subplot(gs[1, 0])]
+        images = [ax.imshow(a, origin="lower") for ax, a in zip(axes, (real, mean, var))]
+        rplt = fig.add_subplot(gs[1, 1], xlabel="Samples", ylabel="RMSE")
+        line, = rplt.plot([], [])
+        return [fig, images, line, rplt, axes]
+
+    def __draw(self, artists, real, mean, var, rmse_log, label):
+        fig, images, line, rplt, axes = artists
+        titles = ["Real Map", "Predicted Mean", "Prediction Variance"]
+        for image, ax, title, a in zip(images, axes, titles, (real, mean, var)):
+            image.set_data(a)
+            image.set_extent((-0.5, a.shape[1] - 0.5, -0.5, a.shape[0] - 0.5))
+            image.set_clim(np.min(a), np.max(a))
+            ax.set_title(f"{title}{label}")
+        line.set_data(np.arange(len(rmse_log)), rmse_log)
+        rplt.set_title(f"RMSE{label}")
+        rplt.relim()
+        rplt.autoscale_view()
@@ -1,5 +1,8 @@
 from model import *
 from region import *
+from acquisition import *
+from planner import *
+from tiled import *
 import math
 
 class Robot(object):
@@ -31,6 +34,12 @@ class Robot(object):
         self.plt_lbl = plt_lbl
 
         self.log_interval = rmse_log_interval
+        # Per-phase counts and times of this robot's simulation, including the model's refits and predictions.
+        self.timer = Timer()
+        # A render.Renderer that display() sends frames to instead of opening a window, if set.
+        self.renderer = None
+        # If set, called with the robot after each step of find_source(), ex. to save a snapshot.
+        self.after_step = None
 
     def guess(self):
         '''
@@ -43,23 +52,55 @@ class Robot(object):
         if len(self.model.input) == 0:
             return Vector(0, 0, 0), 0
         else:
-            prediction = self.model.predict(Region((0,0,0), self.map.size))
-            pos = prediction.sorted_mean[0][0]
-            if self.map.size[1] > 0:
-                return pos, prediction.var[pos.x][pos.y][pos.z]
-            else:
-                return pos, prediction.var[pos.x][pos.z]
+            prediction = self.model.predict(Region((0,0,0), self.map.size), "mean")
+            pos = prediction.position(prediction.argmin("mean"))
+            # Only the variance at the guess is needed, which is much cheaper than all of it in 3D.
+            point = [pos.x, pos.y, pos.z] if self.model.d3 else [pos.x, pos.z]
+            return pos, float(self.model.predict_points(np.array([point], dtype=float), "var")[1][0, 0])
+
+    def state(self):
+        '''
+        The robot's position, destination and counters, as a dict of plain Python values. See load_state().
+        '''
+        return {
+            "pos": [float(v) for v in self.pos],
+            "dest": [float(v) for v in self.dest],
+            "sample_amt": self.sample_amt,
+        }
+
+    def load_state(self, state):
+        '''
+        Restores the robot from state(). find_source() then carries on from where the robot was.
+        '''
+        self.pos = Vector(state["pos"])
+        self.dest = Vector(state["dest"])
+        self.sample_amt = state["sample_amt"]
+
+    def measure(self):
+        '''
+        Take a sample at the current position without adding it to the model.
+        Returns the position and the sampled value.
+        '''
+        self.sample_amt += 1
+        return self.pos, self.map.sample(self.pos)
 
     def take_sample(self):
         '''
         Take a sample at the current position and add it to the model.
         '''
-        self.model.sample(self.pos, self.map.sample(self.pos))
-        self.sample_amt += 1
+        with self.timer.phase("sample"):
+            self.record(*self.measure())
         if self.log_interval != 0 and self.sample_amt % self.log_interval == 0:
+            with self.timer.phase("rmse"):
                 self.model.log_rmse(self.map)
 
 
+    def record(self, pos, val):
+        '''
+        Adds a sample taken by this robot to the model.
+        '''
+        self.model.sample(pos, val)
+
     def update_dest(self):
         '''
         Choose a destination to travel to.
@@ -86,34 +127,45 @@ class Robot(object):
 
     def find_source(self, display=0):
         '''
-        Simulate the robot.
-        '''
-        # Take a sample from the starting position
-        self.take_sample()
-        # Keep track of this for the random UGV
-        # Until the robot is done taking samples (usually when it's reached a max sample amt)
-        while not self.done():
-            self.move_towards_dest()
-            # Take a sample at each stop
-            self.take_sample()
-            if self.update_per_sample or self.pos == self.dest:
-                # Update destination, if applicable
-                self.update_dest()
-            # Display a set of plots, if asked for
-            if display is not True and display > 0 and self.sample_amt % display == 0:
-                self.display(label=self.plt_lbl)
-
-        # Display final plot
-        if display is True or display > 0:
-            self.display(label=self.plt_lbl)
+        Simulate the robot. Time spent in each phase is recorded in self.timer. If the robot was
+        restored with load_state(), this resumes its simulation.
+        '''
+        # The model's refits and predictions are counted as this robot's while it runs.
+        model_timer, self.model.timer = self.model.timer, self.timer
+        try:
+            # Take a sample from the starting position, unless this is resumed
+            if self.sample_amt == 0:
+                self.take_sample()
+            # Keep track of this for the random UGV
+            # Until the robot is done taking samples (usually when it's reached a max sample amt)
+            while not self.done():
+                self.move_towards_dest()
+                # Take a sample at each stop
+                self.take_sample()
+                if self.update_per_sample or self.pos == self.dest:
+                    # Update destination, if applicable
+                    with self.timer.phase("select"):
+                        self.update_dest()
+                # Display a set of plots, if asked for
+                if display is not True and display > 0 and self.sample_amt % display == 0:
+                    with self.timer.phase("display"):
+                        self.display(label=self.plt_lbl)
+                if self.after_step is not None:
+                    self.after_step(self)
 
+            # Display final plot
+            if display is True or display > 0:
+                with self.timer.phase("display"):
+                    self.display(label=self.plt_lbl)
+        finally:
+            self.model.timer = model_timer
         return self.sample_amt
 
     def display(self, rgn=None, label=None):
         '''
-        Display current prediction and RMSE using matplotlib.
+        Display current prediction and RMSE using matplotlib, or send them to self.renderer as a frame
+        if it's set. In 3D, a horizontal slice of rgn at the robot's height is shown.
         '''
-        import matplotlib.pyplot as plt
         # print(f"Label: {label}")
         if label is None:
             label = ""
@@ -121,15 +173,24 @@ class Robot(object):
             label = f": {label}"
         if rgn is None:
             rgn = Region((0, 0, 0), self.map.size)
-        assert(rgn.b.y == 0)
+        if self.model.d3:
+            y = min(max(int(self.pos.y), rgn.a.y), rgn.a.y + rgn.shape(True)[1] - 1)
+            rgn = Region((rgn.a.x, y, rgn.a.z), (rgn.b.x, y, rgn.b.z))
+            label = f"{label} (y = {y})"
         pred = self.model.predict(rgn)
+        mean, var, real = pred.mean, pred.var, self.map.sample_rgn(rgn)
+        if self.model.d3:
+            mean, var, real = mean[:, 0, :], var[:, 0, :], real[:, 0, :]
+        if self.renderer is not None:
+            self.renderer.frame(real, mean, var, self.model.rmse_log, f"{label} ({self.sample_amt} samples)")
+            return
+
+        import matplotlib.pyplot as plt
         fig = plt.figure()
         gs = fig.add_gridspec(2, 2)
 
         gcon = fig.add_subplot(gs[0, 0], title=f"Real Map{label}")
-        gcon.imshow(self.map.sample_rgn(rgn), origin="lower")
-
-        mean, var = pred.cleaned_vals()
+        gcon.imshow(real, origin="lower")
 
         mcon = fig.add_subplot(gs[0, 1], title=f"Predicted Mean{label}")
         mcon.imshow(mean, origin="lower")
@@ -147,35 +208,98 @@ class UGV(Robot):
     '''
     A simulated ground vehicle that either chooses destinations randomly or chooses the least certain point.
     '''
-    def __init__(self, grid, model, pos, move_range, rgn, samples, rand=False, rmse_log_interval=0):
+    def __init__(self, grid, model, pos, move_range, rgn, samples, rand=False, rmse_log_interval=0, rng=None,
+                 candidates=0, batch=0):
         '''
         Create a new UGV.
         Args (that aren't in the Robot class):
         * rgn: Region in which to operate (usually smaller than the grid)
         * samples: Total samples to take.
         * rand: Whether to choose destinations randomly
+        * rng: The numpy.random.Generator used to choose random destinations. If None, a new unseeded one.
+        * candidates: If above 0, choose the least certain point among a coarse lattice of about this many
+          points, refined locally, instead of predicting all of rgn. See acquisition.Acquisition.
+        * batch: If above 0, choose this many destinations at once, and add the samples taken on the way
+          to them to the model together, so that it's refit once per batch. See planner.BatchPlanner.
+          candidates then sets the size of the lattice of points to choose from.
         '''
         if rand:
             lbl = "Random"
         else:
             lbl = f"UGV"
-        super(UGV, self).__init__(grid, model, pos, move_range, True, rmse_log_interval, plt_lbl=lbl)
+        super(UGV, self).__init__(grid, model, pos, move_range, batch <= 0 or rand, rmse_log_interval, plt_lbl=lbl)
         self.rgn = rgn
         self.rand = rand
         self.start = self.pos
         self.samples = samples
         self.total_samples = samples
+        self.rng = np.random.default_rng(rng)
+        self.acquisition = None
+        self.planner = None
+        # Destinations left in the current batch, and samples not yet added to the model
+        self.plan = []
+        self.pending = []
+        if batch > 0 and not rand:
+            if isinstance(model, TiledModel):
+                raise ValueError("Batch planning needs a single GP, so it can't be used with a TiledModel")
+            self.planner = BatchPlanner(model, rgn, batch, move_range, candidates)
+        elif candidates > 0 and not rand:
+            self.acquisition = Acquisition(model, rgn, candidates)
+
+    def state(self):
+        '''
+        As Robot.state(), plus the remaining samples, the current batch and the state of self.rng.
+        Candidates for destinations (see Acquisition) aren't included; they're rebuilt from the model.
+        '''
+        state = super(UGV, self).state()
+        state["samples"] = self.samples
+        state["rng"] = self.rng.bit_generator.state
+        state["plan"] = [[float(v) for v in dest] for dest in self.plan]
+        state["pending"] = [[float(pos.x), float(pos.y), float(pos.z), float(val)] for pos, val in self.pending]
+        return state
+
+    def load_state(self, state):
+        super(UGV, self).load_state(state)
+        self.samples = state["samples"]
+        self.rng.bit_generator.state = state["rng"]
+        self.plan = [Vector(dest) for dest in state.get("plan", [])]
+        self.pending = [(Vector(x, y, z), val) for x, y, z, val in state.get("pending", [])]
+
+    def record(self, pos, val):
+        '''
+        Adds a sample to the model, or with a batch planner, holds it until the end of the batch.
+        '''
+        if self.planner is None:
+            super(UGV, self).record(pos, val)
+            return
+        self.pending.append((pos, val))
+        if self.done():
+            self.flush()
+
+    def flush(self):
+        '''
+        Adds the samples held by record() to the model.
+        '''
+        self.model.sample_many(self.pending)
+        self.pending = []
 
     def update_dest(self):
-        if self.rand:
-            self.dest = rand_point(self.rgn)
+        if self.planner is not None:
+            if len(self.plan) == 0:
+                self.flush()
+                self.plan = self.planner.plan(self.pos)
+            self.dest = self.plan.pop(0)
+        elif self.rand:
+            self.dest = rand_point(self.rgn, self.rng)
+        elif self.acquisition is not None:
+            self.dest = self.acquisition.best()
         else:
-            pred = self.model.predict(self.rgn)
-            self.dest = pred.sorted_var[0][0]
+            pred = self.model.predict_target(self.rgn, "var")
+            self.dest = pred.position(pred.argmax("var"))
         self.samples -= 1
 
     def done(self):
-        if self.rand:
+        if self.rand or self.planner is not None:
             return self.sample_amt == self.total_samples
         else:
             return self.samples == 0
@@ -185,31 +309,66 @@ class UAV(Robot):
     '''
     A simulated air vehicle that takes samples along an algorithmically determined path.
     '''
-    def __init__(self, grid, rgn, model, y_pos, sample_rows, rmse_log_interval=0):
+    def __init__(self, grid, rgn, model, y_pos, sample_rows, rmse_log_interval=0, layers=1):
         '''
         Create a new UAV. Move radius is (rgn.size.z / sample_rows) / 2
         Args (that aren't in the robot class):
         * rgn: Region in which to operate
         * y_pos: Height of the UAV (if none, half the height of the region)
         * sample_rows: Number of rows of samples to take.
+        * layers: Amount of altitudes to sweep, evenly spaced through the height of the region. The rows
+          are repeated at each one, alternating direction. If above 1, y_pos is ignored.
         '''
         self.buf = rgn.size.x / sample_rows / 2
         self.step = rgn.size.z / sample_rows
-        if y_pos is None:
-            y_pos = rgn.a.y + rgn.size.y / 2
-        pos = Vector(self.buf, y_pos, self.step / 2)
+        if layers > 1:
+            self.altitudes = [rgn.a.y + (i + 0.5) * rgn.size.y / layers for i in range(layers)]
+        elif y_pos is None:
+            self.altitudes = [rgn.a.y + rgn.size.y / 2]
+        else:
+            self.altitudes = [y_pos]
+        pos = Vector(self.buf, self.altitudes[0], self.step / 2)
         mv_radius = self.step / 2
         super(UAV, self).__init__(grid, model, pos, mv_radius, False, rmse_log_interval, plt_lbl="UAV")
         self.rgn = rgn
         self.row_state = True
         self.rows = sample_rows
         self.total_rows = sample_rows
+        self.layer = 0
+        # Direction of travel along z, which flips at each layer
+        self.z_dir = 1
+        # x at the end of the last row of the current layer, once it's started
+        self.end_x = None
+
+    def state(self):
+        '''
+        As Robot.state(), plus the UAV's progress through its rows and layers.
+        '''
+        state = super(UAV, self).state()
+        state.update(row_state=self.row_state, rows=self.rows, layer=self.layer, z_dir=self.z_dir, end_x=self.end_x)
+        return state
+
+    def load_state(self, state):
+        super(UAV, self).load_state(state)
+        self.row_state = state["row_state"]
+        self.rows = state["rows"]
+        self.layer = state["layer"]
+        self.z_dir = state["z_dir"]
+        self.end_x = state["end_x"]
 
     def update_dest(self):
         '''
-        Chooses destinations such that the UAV follows a series of rows on the grid.
+        Chooses destinations such that the UAV follows a series of rows on the grid, then climbs to
+        the next layer, if any, and follows them back.
         '''
         x, z = self.pos.x, self.pos.z
+        if self.rows == 0 and self.layer < len(self.altitudes) - 1:
+            self.layer += 1
+            self.rows = self.total_rows
+            self.z_dir = -self.z_dir
+            self.row_state = True
+            self.dest = Vector(x, self.altitudes[self.layer], z)
+            return
         if self.row_state:
             # Going left
             if self.pos[0] > self.rgn.size.x / 2:
@@ -217,19 +376,18 @@ class UAV(Robot):
             else:  # Going right
                 x = self.rgn.size.x - self.buf
             self.rows = self.rows - 1
+            if self.rows == 0:
+                self.end_x = x
         else:
-            z += self.step
+            z += self.step * self.z_dir
         self.row_state = not self.row_state
         self.dest = Vector(x, self.pos.y, z)
 
     def done(self):
         '''
-        True if the UAV is at the end of its last row.
+        True if the UAV is at the end of its last row in its last layer.
         '''
-        if self.total_rows % 2 == 0:
-            return self.rows == 0 and self.pos.x == self.buf
-        else:
-            return self.rows == 0 and self.pos.x == self.rgn.size.x - self.buf
+        return self.layer == len(self.altitudes) - 1 and self.rows == 0 and self.pos.x == self.end_x
 
     def suggest(self, w_width=None, w_depth=None):
         '''
@@ -237,45 +395,65 @@ class UAV(Robot):
         to take the average mean of subregions in the UAV's search region, then returning the region of
         the window with the highest mean.
 
-        This assumes that the UGV can only search on the ground, and, therefore, its search region is
-        essentially two-dimensional.
+        This assumes that the UGV searches a single floor, so its search region is essentially
+        two-dimensional. In 3D, windows are found on every y layer of the UAV's region.
 
         Args:
         * w_width: Width of the window. (x)
         * w_depth: Depth of the window. (z)
         '''
+        candidates = self.candidates(1, w_width, w_depth)
+        if len(candidates) == 0:
+            highest, h_rgn = None, Region(self.rgn.a, (self.rgn.b.x, self.rgn.a.y, self.rgn.b.z))
+        else:
+            highest, h_rgn = candidates[0]
+        print(f"Suggestion: {highest} @ {h_rgn}")
+        return h_rgn
+
+    def candidates(self, k, w_width=None, w_depth=None):
+        '''
+        Finds up to k non-overlapping windows with the highest average predicted mean, best first,
+        for dispatching several UGVs. Window sums come from an integral image of the prediction,
+        so every window is scored at once in O(1) each.
+
+        Returns a list of [average mean, Region] pairs.
+
+        Args: As with suggest(), plus:
+        * k: Maximum amount of windows to return.
+        '''
         if w_width is None:
             w_width = int(self.map.size[0] / 3)
         if w_depth is None:
             w_depth = int(self.map.size[2] / 3)
 
-        wsize = Vector(min(w_width, self.map.size[0]), 0, min(w_depth, self.map.size[2]))
-        rgn = Region(
-            self.rgn.a,
-            (self.rgn.b.x, self.rgn.a.y, self.rgn.b.z)
-        )
-        pred = self.model.predict(rgn)
-        highest = None
-        h_rgn = rgn
-        d3 = self.map.size[1] > 0
-        for wx in range(rgn.a.x, rgn.b.x - wsize.x):
-            for wz in range(rgn.a.z, rgn.b.z - wsize.z):
-                w_rgn = Region((wx, 0, wz), (wx + wsize.x, 0, wz + wsize.z))
-                avg = 0
-                i = 0
-                for x in range(w_rgn.a.x, w_rgn.b.x):
-                    xi = x - rgn.a.x
-                    for z in range(w_rgn.a.z,  w_rgn.b.z):
-                        zi = z - rgn.a.z
-                        if d3:
-                            avg += pred.mean[xi][0][zi][1]
-                        else:
-                            avg += pred.mean[xi][zi][1]
-                        i += 1
-                avg /= i
-                if highest is None or avg > highest:
-                    # print(f"{avg} @ {w_rgn} > {highest} @ {h_rgn}")
-                    h_rgn = w_rgn
-                    highest = avg
-        print(f"Suggestion: {highest} @ {h_rgn}")
-        return h_rgn
\ No newline at end of file
+        wsize = Vector(max(min(w_width, self.map.size[0]), 1), 0, max(min(w_depth, self.map.size[2]), 1))
+        if self.model.d3:
+            rgn = self.rgn
+        else:
+            rgn = Region(
+                self.rgn.a,
+                (self.rgn.b.x, self.rgn.a.y, self.rgn.b.z)
+            )
+        pred = self.model.predict_target(rgn, "mean")
+        # Indexed [x, y, z], with a single y layer in 2D
+        mean = pred.mean if pred.d3 else pred.mean[:, None, :]
+        if wsize.x > mean.shape[0] or wsize.z > mean.shape[2]:
+            return []
+        # integral[i, y, j] is the sum of mean[:i, y, :j]
+        integral = np.zeros((mean.shape[0] + 1, mean.shape[1], mean.shape[2] + 1))
+        integral[1:, :, 1:] = mean.cumsum(axis=0).cumsum(axis=2)
+        sums = integral[wsize.x:, :, wsize.z:] - integral[:-wsize.x, :, wsize.z:] \
+            - integral[wsize.x:, :, :-wsize.z] + integral[:-wsize.x, :, :-wsize.z]
+        avgs = sums / (wsize.x * wsize.z)
+
+        res = []
+        while len(res) < k:
+            xi, yi, zi = np.unravel_index(np.argmax(avgs), avgs.shape)
+            if avgs[xi, yi, zi] == -np.inf:
+                break
+            wx, wz = rgn.a.x + int(xi), rgn.a.z + int(zi)
+            wy = rgn.a.y + int(yi) if pred.d3 else 0
+            res.append([float(avgs[xi, yi, zi]), Region((wx, wy, wz), (wx + wsize.x, wy, wz + wsize.z))])
+            # Rule out every window on the same layer that overlaps this one
+            avgs[max(xi - wsize.x + 1, 0):xi + wsize.x, yi, max(zi - wsize.z + 1, 0):zi + wsize.z] = -np.inf
+        return res
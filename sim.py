@@ -14,9 +14,68 @@ from util import *
 from region import *
 from robot import *
 from model import *
+from telemetry import open_telemetry
+from render import Renderer
+from diskcache import DiskCache
 import tests
 import time
 
+def add_model_args(parser):
+    '''
+    Adds the arguments that configure the GP Model to an argparse parser.
+    '''
+    parser.add_argument("--refit", type=int, default=1, dest="refit_interval", help="Samples between full GP refits. Samples in between are added incrementally. 1 refits on every sample, 0 only on drift.")
+    parser.add_argument("--refit_drift", type=float, default=None, dest="refit_drift", help="Also refit when the per-sample log likelihood drifts by more than this.")
+    parser.add_argument("--optimizer", default="lbfgsb", dest="optimizer", help="Optimizer for GP hyperparameters. (ex. lbfgsb, scg, bfgs)")
+    parser.add_argument("--max_iters", type=int, default=1000, dest="max_iters", help="Iteration cap for each GP hyperparameter optimization.")
+    parser.add_argument("--cold_start", action="store_true", dest="cold_start", help="Optimize GP hyperparameters from the kernel defaults on every refit instead of the last fit.")
+    parser.add_argument("--rmse_cells", type=int, default=0, dest="rmse_cells", help="Estimate RMSE from this many randomly chosen cells. 0 to use every cell.")
+    parser.add_argument("--rmse_stride", type=int, default=1, dest="rmse_stride", help="Estimate RMSE on a lattice with this spacing.")
+    parser.add_argument("--sparse", action="store_true", dest="sparse", help="Use a sparse GP with inducing points.")
+    parser.add_argument("--sparse_threshold", type=int, default=0, dest="sparse_threshold", help="Switch to a sparse GP once the model has this many samples. 0 for never.")
+    parser.add_argument("--inducing", type=int, default=100, dest="inducing", help="Amount of sparse GP inducing points.")
+    parser.add_argument("--cache_mb", type=int, default=256, dest="cache_mb", help="Memory bound for cached predictions, in MB.")
+    parser.add_argument("--adaptive", type=int, default=0, dest="adaptive", help="If above 0, robots choose points from adaptive predictions refined from tiles this many cells wide, instead of predicting every cell.")
+    parser.add_argument("--adaptive_tol", type=float, default=0.05, dest="adaptive_tol", help="Largest difference within an unrefined tile of an adaptive prediction, as a fraction of the range of values.")
+    parser.add_argument("--tile", type=int, default=0, dest="tile", help="If above 0, use local GPs on tiles this wide instead of one GP over every sample.")
+    parser.add_argument("--tile_overlap", type=float, default=0.25, dest="tile_overlap", help="How far each tile's GP reaches beyond the tile, as a fraction of --tile.")
+    parser.add_argument("--tile_workers", type=int, default=0, dest="tile_workers", help="If above 1, refit tiles' GPs in a process pool with this many workers.")
+    parser.add_argument("--inducing_placement", default="kmeans", choices=["grid", "kmeans", "subset"], dest="inducing_placement", help="How to place sparse GP inducing points.")
+
+
+def get_model_opts(args):
+    '''
+    Gets Model keyword arguments from arguments parsed with add_model_args().
+    '''
+    return {
+        "refit_interval": args.refit_interval,
+        "refit_drift": args.refit_drift,
+        "optimizer": args.optimizer,
+        "max_iters": args.max_iters,
+        "warm_start": not args.cold_start,
+        "rmse_cells": args.rmse_cells,
+        "rmse_stride": args.rmse_stride,
+        "sparse": args.sparse,
+        "sparse_threshold": args.sparse_threshold,
+        "inducing": args.inducing,
+        "inducing_placement": args.inducing_placement,
+        "cache_bytes": args.cache_mb * 1024 * 1024,
+        "adaptive": args.adaptive,
+        "tile": args.tile,
+        "overlap": args.tile_overlap,
+        "workers": args.tile_workers,
+        "adaptive_tol": args.adaptive_tol,
+    }
+
+def print_timings(timings):
+    '''
+    Prints the time spent in each phase by each robot, from the output of tests.timings().
+    '''
+    for name, phases in timings.items():
+        summary = ", ".join(f"{phase}: {p['seconds']:.3f}s ({p['count']})" for phase, p in phases.items())
+        print(f"{name} phases: {summary}")
+
+
 def main():
     parser = argparse.ArgumentParser(description='WiFi Mapper')
     parser.add_argument("-s", type=int, nargs=3, default=[12, 12, 12], dest="size", help="Grid size. [x, y, z]")
@@ -24,12 +83,40 @@ def main():
     parser.add_argument("-m", type=int, default=12, dest="samples", help="Amount of UGV samples.")
     parser.add_argument("-v", type=int, default=4, dest="uav_rows", help="Amount of UAV rows.")
     parser.add_argument("-r", type=int, default=8, dest="radius", help="UGV movement radius.")
+    parser.add_argument("--ugvs", type=int, default=1, dest="ugvs", help="Amount of UGVs. Above 1, a fleet of variance UGVs is simulated, without a random robot.")
+    parser.add_argument("--seed", type=int, default=None, dest="seed", help="Seed for the simulation's random numbers. Random if not set.")
     parser.add_argument("--rmse", type=int, default=0, dest="rmse", help="Interval between RMSE logs. 0 for none.")
     parser.add_argument("--csv", action="store_true", dest="csv", help="Generate CSV version of RMSE log instead of displaying graphs.")
     parser.add_argument("--display", type=int, dest="display", help="Interval between display of matplotlib graphs. 0 for none. Does nothing if --csv is active.")
+    parser.add_argument("--candidates", type=int, default=0, dest="candidates", help="If above 0, the UGV chooses destinations among about this many candidate points instead of its whole region.")
+    parser.add_argument("--batch", type=int, default=0, dest="batch", help="If above 0, the UGV chooses this many destinations at a time, and the model is refit once per batch instead of once per sample.")
+    parser.add_argument("--layers", type=int, default=1, dest="layers", help="Amount of altitudes for the UAV to sweep in 3D.")
     parser.add_argument("--no_rand", action="store_true", dest="no_rand", help="Whether to skip testing of random robot. Does nothing if --csv is active.")
+    add_model_args(parser)
+    parser.add_argument("--telemetry", default=None, dest="telemetry", help="Stream RMSE, sample and timing events to this file as they happen. (.csv, .jsonl or .npy)")
+    parser.add_argument("--flush", type=float, default=1.0, dest="flush", help="Maximum seconds that a telemetry event stays buffered before it is written.")
+    parser.add_argument("--render", default=None, dest="render", help="Write displayed frames to this directory as PNGs, or to a .gif or .mp4 animation, instead of opening windows. Every sample is a frame unless --display is set.")
+    parser.add_argument("--fps", type=int, default=4, dest="fps", help="Frames per second of a --render animation.")
+    parser.add_argument("--cache", default=None, dest="cache", help="Directory of a cache for map ground truth and UAV sweep results, shared between runs.")
+    parser.add_argument("--cache_size", type=int, default=1024, dest="cache_size", help="Size cap of --cache, in MB.")
+    parser.add_argument("--snapshot", default=None, dest="snapshot", help="With --no_rand, save snapshots of the run to this file every --snapshot_interval samples, and one after the UAV's sweep to FILE.uav (ex. run.uav.npz for run.npz).")
+    parser.add_argument("--snapshot_interval", type=int, default=0, dest="snapshot_interval", help="Samples between snapshots. 0 for only the one after the UAV's sweep.")
+    parser.add_argument("--resume", default=None, dest="resume", help="With --no_rand, resume a run from a snapshot. The other arguments must match the snapshot's run.")
     parser.add_argument("--profile", action="store_true", dest="profile", help="Profile this program using cProfile.")
     args = parser.parse_args()
+    if args.tile > 0 and args.batch > 0:
+        parser.error("--batch can't be used with --tile, since batch planning needs a single GP")
+    model_opts = get_model_opts(args)
+    if args.telemetry is not None:
+        model_opts["telemetry"] = open_telemetry(args.telemetry, flush_interval=args.flush)
+    cache = None
+    if args.cache is not None:
+        cache = DiskCache(args.cache, args.cache_size * 1024 * 1024)
+    renderer = None
+    if args.render is not None:
+        renderer = Renderer(args.render, args.fps)
+        if args.display is None:
+            args.display = 1
     start = time.time()
 
     if args.profile:
@@ -37,19 +124,39 @@ def main():
         profile = cProfile.Profile(builtins=False)
         profile.enable()
 
-    if args.csv:
-        print(tests.rmse_csv(args.size, args.src_amt, args.samples, args.uav_rows, args.radius))
+    if args.ugvs > 1:
+        map_seed, run_seed = np.random.SeedSequence(args.seed).spawn(2)
+        grid = Map(size=args.size, src_amt=args.src_amt, seed=map_seed)
+        guess, rmse, samples, timings = tests.fleet_test(grid, args.ugvs, args.samples, args.uav_rows, args.radius, args.rmse,
+                                                         np.random.default_rng(run_seed), args.candidates, args.layers,
+                                                         **model_opts)
+        print(f"RMSE: {rmse[-1]}")
+        print(f"Time: {time.time() - start}")
+        print_timings(timings)
+    elif args.csv:
+        print(tests.rmse_csv(args.size, args.src_amt, args.samples, args.uav_rows, args.radius, args.seed, args.candidates, args.layers,
+                             cache, args.batch, **model_opts))
     elif args.no_rand:
-        grid = Map(size=args.size, src_amt=args.src_amt)
-        guess, rmse, samples = tests.test(grid, args.samples, args.uav_rows, args.radius, False, args.rmse, args.display)
+        map_seed, run_seed = np.random.SeedSequence(args.seed).spawn(2)
+        grid = Map(size=args.size, src_amt=args.src_amt, seed=map_seed)
+        guess, rmse, samples, timings = tests.test(grid, args.samples, args.uav_rows, args.radius, False, args.rmse, args.display,
+                                                   np.random.default_rng(run_seed), args.candidates, args.layers, renderer,
+                                                   cache, args.snapshot, args.snapshot_interval, args.resume,
+                                                   args.batch, **model_opts)
         print(f"RMSE: {rmse[-1]}")
         print(f"Time: {time.time() - start}")
+        print_timings(timings)
     else:
-        v_err, r_err = tests.compare(args.size, args.src_amt, args.samples, args.uav_rows, args.radius, args.rmse, args.display)
+        v_err, r_err = tests.compare(args.size, args.src_amt, args.samples, args.uav_rows, args.radius, args.rmse, args.display, args.seed, args.candidates, args.layers, renderer, cache, args.batch, **model_opts)
         if args.rmse > 0:
             print(f"Error: V: {v_err[-1]}, R: {r_err[-1]}")
         print(f"Time: {time.time() - start}")
 
+    if args.telemetry is not None:
+        model_opts["telemetry"].close()
+    if renderer is not None:
+        renderer.close()
+
     if args.profile:
         profile.disable()
         s_stream = io.StringIO()
@@ -57,7 +164,7 @@ def main():
         p_stats.print_stats()
         print(s_stream.getvalue())
 
-    if args.display:
+    if args.display and renderer is None:
         input("Press enter to continue...")
 
 
@@ -0,0 +1,39 @@
+'''
+Snapshots of a simulation in progress, saved to disk so that it can be resumed or forked.
+'''
+
+import json
+import os
+import numpy as np
+
+
+def save(path, state):
+    '''
+    Saves a snapshot as a compressed .npz file, replacing any earlier one atomically, so a run that's
+    killed while saving still leaves the previous snapshot.
+
+    Args:
+    * path: File to save to.
+    * state: A dict of plain Python values. state["model"] should be from Model.state(); its samples
+      are stored as arrays, and everything else as JSON.
+    '''
+    state = dict(state)
+    model = dict(state["model"])
+    inputs = np.array(model.pop("input"), dtype=float)
+    outputs = np.array(model.pop("output"), dtype=float)
+    state["model"] = model
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, input=inputs, output=outputs, state=np.array(json.dumps(state)))
+    os.replace(tmp, path)
+
+
+def load(path):
+    '''
+    Loads a snapshot saved with save(). Returns the same dict that was saved.
+    '''
+    with np.load(path) as data:
+        state = json.loads(str(data["state"]))
+        state["model"]["input"] = data["input"].tolist()
+        state["model"]["output"] = data["output"].tolist()
+    return state
@@ -0,0 +1,203 @@
+'''
+Streaming telemetry sinks. Events (RMSE logs, samples, timings) are buffered and written in
+batches while a simulation runs, instead of being kept in memory until it ends.
+'''
+
+import csv
+import json
+import threading
+import time
+import numpy as np
+
+
+class Telemetry(object):
+    '''
+    An abstract telemetry sink. Events are buffered, and the buffer is written out whenever it
+    fills up, and every flush_interval seconds by a background thread, so that events reach the file
+    even while a long refit or prediction holds up new ones.
+    '''
+    # Every field an event can have. time and kind are added to every event.
+    FIELDS = ["time", "run", "kind", "samples", "rmse", "bound", "x", "y", "z", "value", "name", "seconds"]
+
+    def __init__(self, path, flush_interval=1.0, buffer_size=1024, mode="w"):
+        '''
+        Create a new telemetry sink.
+
+        Args:
+        * path: File to write to.
+        * flush_interval: Maximum seconds that an event stays buffered. If 0, every event is written
+          right away.
+        * buffer_size: Amount of events to buffer before writing, regardless of time.
+        * mode: File mode. "w" for text formats, "wb" for binary ones.
+        '''
+        self.file = open(path, mode)
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.start = time.perf_counter()
+        self.__buffer = []
+        # Held while the buffer or file is used, since the flush thread uses them too
+        self.__lock = threading.RLock()
+        self.__closed = threading.Event()
+        self.__thread = None
+        if flush_interval > 0:
+            self.__thread = threading.Thread(target=self.__flush_periodically, daemon=True)
+            self.__thread.start()
+
+    def __flush_periodically(self):
+        '''
+        Flushes every self.flush_interval seconds until the sink is closed.
+        '''
+        while not self.__closed.wait(self.flush_interval):
+            self.flush()
+
+    def event(self, kind, **fields):
+        '''
+        Records an event. Fields must be in Telemetry.FIELDS.
+        '''
+        fields["time"] = time.perf_counter() - self.start
+        fields["kind"] = kind
+        with self.__lock:
+            self.__buffer.append(fields)
+            if len(self.__buffer) >= self.buffer_size or self.flush_interval <= 0:
+                self.flush()
+
+    def tagged(self, **tags):
+        '''
+        Returns a view of this sink that adds tags (ex. run="variance") to every event.
+        '''
+        return TaggedTelemetry(self, tags)
+
+    def flush(self):
+        '''
+        Writes out buffered events.
+        '''
+        with self.__lock:
+            if self.file.closed:
+                return
+            if len(self.__buffer) > 0:
+                self.write(self.__buffer)
+                self.__buffer = []
+            self.file.flush()
+
+    def write(self, events):
+        '''
+        Writes a batch of events to self.file. Implemented by each format.
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        self.__closed.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        with self.__lock:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TaggedTelemetry(object):
+    '''
+    A view of a Telemetry sink that adds fixed fields to every event.
+    '''
+    def __init__(self, sink, tags):
+        self.sink = sink
+        self.tags = tags
+
+    def event(self, kind, **fields):
+        self.sink.event(kind, **self.tags, **fields)
+
+    def tagged(self, **tags):
+        return TaggedTelemetry(self.sink, {**self.tags, **tags})
+
+    def flush(self):
+        self.sink.flush()
+
+
+class CSVTelemetry(Telemetry):
+    '''
+    Writes events as CSV rows with a column for every field in Telemetry.FIELDS.
+    Fields an event doesn't have are left empty.
+    '''
+    def __init__(self, path, **kwargs):
+        super(CSVTelemetry, self).__init__(path, mode="w", **kwargs)
+        self.writer = csv.DictWriter(self.file, self.FIELDS)
+        self.writer.writeheader()
+
+    def write(self, events):
+        self.writer.writerows(events)
+
+
+class JSONTelemetry(Telemetry):
+    '''
+    Writes events as JSON lines.
+    '''
+    def __init__(self, path, **kwargs):
+        super(JSONTelemetry, self).__init__(path, mode="w", **kwargs)
+
+    def write(self, events):
+        self.file.write("".join(json.dumps(e) + "\n" for e in events))
+
+
+class ColumnarTelemetry(Telemetry):
+    '''
+    Writes events as a sequence of numpy structured arrays, one per kind of event in each batch,
+    each preceded by an array holding the kind's name. Read it with read_columnar().
+    '''
+    def __init__(self, path, **kwargs):
+        super(ColumnarTelemetry, self).__init__(path, mode="wb", **kwargs)
+
+    def write(self, events):
+        kinds = {}
+        for e in events:
+            kinds.setdefault(e["kind"], []).append(e)
+        for kind, group in kinds.items():
+            fields = [f for f in self.FIELDS if f != "kind" and any(f in e for e in group)]
+            dtype = []
+            for f in fields:
+                if any(isinstance(e.get(f), str) for e in group):
+                    dtype.append((f, "U64"))
+                else:
+                    dtype.append((f, "f8"))
+            rows = [tuple(e.get(f, "" if t == "U64" else np.nan) for f, t in dtype) for e in group]
+            np.save(self.file, np.array(kind))
+            np.save(self.file, np.array(rows, dtype=dtype))
+
+
+def read_columnar(path):
+    '''
+    Reads a file written by ColumnarTelemetry. Returns a dict from kind of event to a structured
+    array of all of that kind's events.
+    '''
+    blocks = {}
+    with open(path, "rb") as f:
+        while True:
+            try:
+                kind = str(np.load(f))
+            except (EOFError, ValueError):
+                break
+            blocks.setdefault(kind, []).append(np.load(f))
+    res = {}
+    for kind, arrays in blocks.items():
+        # Batches of the same kind can have different fields, so only the common ones are kept.
+        names = [n for n in arrays[0].dtype.names if all(n in a.dtype.names for a in arrays)]
+        res[kind] = np.concatenate([a[names] for a in arrays]) if len(arrays) > 1 else arrays[0]
+    return res
+
+
+def open_telemetry(path, **kwargs):
+    '''
+    Opens a telemetry sink, choosing the format from the file extension:
+    .csv, .jsonl/.json, or .npy for ColumnarTelemetry.
+    '''
+    if path.endswith(".csv"):
+        return CSVTelemetry(path, **kwargs)
+    elif path.endswith(".jsonl") or path.endswith(".json"):
+        return JSONTelemetry(path, **kwargs)
+    elif path.endswith(".npy"):
+        return ColumnarTelemetry(path, **kwargs)
+    raise ValueError(f"Unknown telemetry format: {path}")
@@ -2,16 +2,21 @@
 Methods for testing the robot simulations.
 '''
 
+import os
 from region import *
 from model import *
 from util import *
 from robot import *
+from fleet import *
+from tiled import *
+from snapshot import save as save_snapshot, load as load_snapshot
 
 
-def test(grid, samples, uav_rows, radius, rand, rmse_log_interval, display):
+def test(grid, samples, uav_rows, radius, rand, rmse_log_interval, display, rng=None, candidates=0, layers=1,
+         renderer=None, cache=None, snapshot=None, snapshot_interval=0, resume=None, batch=0, **model_opts):
     '''
     Runs a robot simulation and returns the best guess for WiFi source position, the RMSE log (if desired),
-    and the total number of samples taken.
+    the total number of samples taken, and the time spent in each phase. See timings().
 
     Args:
     * samples: Amount of samples for the UGV to take.
@@ -20,61 +25,236 @@ def test(grid, samples, uav_rows, radius, rand, rmse_log_interval, display):
     * rand: Whether to test the random destination selection method or the variance method.
     * rmse_log_interval: How many samples to take before logging RMSE. If 0, RMSE is not logged.
     * display: Interval between display of matplotlib graphs.
+    * rng: The numpy.random.Generator for the robots. If None, a new unseeded one.
+    * candidates: If above 0, the UGV chooses destinations among about this many candidate points. See UGV.
+    * layers: Amount of altitudes for the UAV to sweep, in 3D. See UAV.
+    * renderer: A render.Renderer to write displayed frames to, instead of opening windows.
+    * cache: A diskcache.DiskCache for the map's field and the results of the UAV's sweep. If the same
+      map and UAV settings were run before, the sweep and its training are skipped.
+    * snapshot: File to save snapshots of the run to (see snapshot.save()), every snapshot_interval
+      samples. One is always saved after the UAV's sweep, to its own file (see uav_snapshot()), which
+      UGVs can be forked from (see fork()).
+    * snapshot_interval: If above 0, save a snapshot every this many samples of each robot.
+    * resume: A snapshot file to resume the run from. grid must be the same map the snapshot was taken on.
+    * batch: If above 0, the UGV chooses this many destinations at a time, and the model is refit once per
+      batch. See UGV.
+    * model_opts: Extra keyword arguments for the Model.
     '''
-    model = Model(grid.size[1] > 0)
+    model = new_model(grid.size[1] > 0, **model_opts)
     sample_total = 0
+    timers = {}
+    if cache is not None:
+        cache.field(grid)
+    state = None
+    if resume is not None:
+        state = load_snapshot(resume)
+        grid.load_state(state["map"])
+        model.load_state(state["model"])
+        sample_total = state["samples"]
+    phase = "uav" if state is None else state["phase"]
 
-    if not rand:
+    def save(phase, robot, rgn=None, path=snapshot):
+        save_snapshot(path, {
+            "phase": phase,
+            "map": grid.state(),
+            "model": model.state(),
+            "robot": None if robot is None else robot.state(),
+            "samples": sample_total,
+            "rgn": None if rgn is None else [list(rgn.a), list(rgn.b)],
+        })
+
+    def saver(phase, rgn=None):
+        # Called after each step of a robot
+        def after_step(robot):
+            if robot.sample_amt % snapshot_interval == 0:
+                save(phase, robot, rgn)
+        return after_step if snapshot is not None and snapshot_interval > 0 else None
+
+    if not rand and phase == "uav":
         rgn = Region((0, 0, 0), grid.size)
         if rgn.b.y == 0:
             y_pos = 0
         else:
             y_pos = None
-        uav = UAV(grid, rgn, model, y_pos, uav_rows, rmse_log_interval)
+        uav = UAV(grid, rgn, model, y_pos, uav_rows, rmse_log_interval, layers)
+        uav.renderer = renderer
+        uav.after_step = saver("uav")
+        if state is not None:
+            uav.load_state(state["robot"])
         uav_disp = display
         if uav_disp is not False:
             uav_disp = True
-        sample_total += uav.find_source(display=uav_disp)
-        rgn = uav.suggest()
+        swept = None
+        if cache is not None and state is None:
+            uav_key = cache.key(grid.key(), uav_rows, layers, rmse_log_interval,
+                                {k: v for k, v in model_opts.items() if k != "telemetry"})
+            swept = cache.load_json(uav_key, "uav.json")
+        if swept is not None:
+            grid.load_state(swept["map"])
+            model.load_state(swept["model"])
+            sample_total += swept["samples"]
+            rgn = Region(*swept["suggestion"])
+            print(f"Suggestion (cached): {rgn}")
+        else:
+            sample_total += uav.find_source(display=uav_disp)
+            timers["UAV"] = uav.timer
+            rgn = uav.suggest()
+            if cache is not None and state is None:
+                cache.save_json(uav_key, "uav.json", {
+                    "map": grid.state(),
+                    "model": model.state(),
+                    "samples": uav.sample_amt,
+                    "suggestion": [list(rgn.a), list(rgn.b)],
+                })
+        if snapshot is not None:
+            save("ugv", None, rgn, uav_snapshot(snapshot))
+    elif phase == "ugv":
+        rgn = Region(*state["rgn"])
     else:
         rgn = Region((0, 0, 0), (grid.size[0], 0, grid.size[2]))
 
-    ugv = UGV(grid, model, rgn.a, radius, rgn, samples, rand, rmse_log_interval)
+    ugv = UGV(grid, model, rgn.a, radius, rgn, samples, rand, rmse_log_interval, rng, candidates, batch)
+    ugv.renderer = renderer
+    ugv.after_step = saver("ugv", rgn)
+    if phase == "ugv" and state["robot"] is not None:
+        ugv.load_state(state["robot"])
     sample_total += ugv.find_source(display=display)
+    timers[ugv.plt_lbl] = ugv.timer
 
     guess = ugv.guess()[0]
 
     model.log_rmse(grid)
-    return guess, model.rmse_log, sample_total,
+    model.close()
+    return guess, model.rmse_log, sample_total, timings(timers)
+
+
+def uav_snapshot(path):
+    '''
+    The file that test() saves the snapshot taken after the UAV's sweep to, for snapshots saved to path.
+    ex. run.npz -> run.uav.npz
+    '''
+    root, ext = os.path.splitext(path)
+    return f"{root}.uav{ext}"
+
+
+def fork(grid, path, samples, radius, strategies, rmse_log_interval=0, seed=None, **model_opts):
+    '''
+    Runs several UGVs from the snapshot test() saves after the UAV's sweep, so that the sweep is only
+    paid for once. Returns a list of the RMSE logs.
+
+    Args: the same as test(), plus:
+    * path: The snapshot file, from uav_snapshot(). Other snapshots aren't accepted, since they're
+      of a robot that already started.
+    * strategies: A list of dicts of keyword arguments for test() that differ between the UGVs,
+      ex. [{"rand": True}, {"candidates": 256}].
+    * seed: Seed for the UGVs. Each gets its own random stream from it.
+    '''
+    state = load_snapshot(path)
+    if state["phase"] != "ugv" or state["robot"] is not None:
+        raise ValueError(f"{path} isn't a snapshot from the end of a UAV's sweep")
+    logs = []
+    for strategy, ugv_seed in zip(strategies, np.random.SeedSequence(seed).spawn(len(strategies))):
+        opts = dict(model_opts, **strategy)
+        rand = opts.pop("rand", False)
+        logs.append(test(grid, samples, 0, radius, rand, rmse_log_interval, False, np.random.default_rng(ugv_seed),
+                         resume=path, **opts)[1])
+    return logs
+
+
+def fleet_test(grid, ugvs, samples, uav_rows, radius, rmse_log_interval, rng=None, candidates=0, layers=1,
+               **model_opts):
+    '''
+    Runs a UAV, then a fleet of variance UGVs that each search a different one of the UAV's suggested
+    regions, all sharing one model. Returns the same as test().
+
+    Args: the same as test(), plus:
+    * ugvs: Amount of UGVs.
+    '''
+    model = new_model(grid.size[1] > 0, **model_opts)
+    sample_total = 0
+
+    rgn = Region((0, 0, 0), grid.size)
+    if rgn.b.y == 0:
+        y_pos = 0
+    else:
+        y_pos = None
+    uav = UAV(grid, rgn, model, y_pos, uav_rows, rmse_log_interval, layers)
+    sample_total += uav.find_source(display=False)
+    timers = {"UAV": uav.timer}
+
+    robots = []
+    for avg, c_rgn in uav.candidates(ugvs):
+        print(f"Suggestion: {avg} @ {c_rgn}")
+        robots.append(UGV(grid, model, c_rgn.a, radius, c_rgn, samples, False, 0, rng, candidates))
+    fleet = Fleet(model, robots, rmse_log_interval)
+    sample_total += fleet.run()
+    timers["Fleet"] = fleet.timer
+
+    guess = robots[0].guess()[0]
+
+    model.log_rmse(grid)
+    model.close()
+    return guess, model.rmse_log, sample_total, timings(timers)
 
 
-def compare(size, src_amt, samples, uav_rows, radius, rmse_log_interval, display):
+def timings(timers):
+    '''
+    Summarizes the Timers of a run's robots. Returns a dict from robot name, plus "total" for all of
+    them together, to each phase's {"count": calls, "seconds": total seconds}.
+    '''
+    total = Timer()
+    res = {}
+    for name, timer in timers.items():
+        total.merge(timer)
+        res[name] = timer.summary()
+    res["total"] = total.summary()
+    return res
+
+
+def tag_telemetry(model_opts, run):
+    '''
+    Returns model_opts with its telemetry sink, if any, tagging events with the name of the run.
+    '''
+    if model_opts.get("telemetry") is None:
+        return model_opts
+    return dict(model_opts, telemetry=model_opts["telemetry"].tagged(run=run))
+
+
+def compare(size, src_amt, samples, uav_rows, radius, rmse_log_interval, display, seed=None, candidates=0, layers=1,
+            renderer=None, cache=None, batch=0, **model_opts):
     '''
     Runs test() for a random robot and a variance robot, then returns the rmse logs for both.
 
-    Args: the same as test()
+    Args: the same as test(), plus:
+    * seed: Seed for the whole comparison. The map and each robot get their own random stream from it.
     '''
-    grid = Map(size=size, src_amt=src_amt)
+    map_seed, v_seed, r_seed = np.random.SeedSequence(seed).spawn(3)
+    grid = Map(size=size, src_amt=src_amt, seed=map_seed)
     print(f"Real: {grid.srcs}")
-    v_guess, v_rmse, v_samples = test(grid, samples, uav_rows, radius, False, rmse_log_interval, display)
+    v_guess, v_rmse, v_samples, v_timings = test(grid, samples, uav_rows, radius, False, rmse_log_interval, display,
+                                                 np.random.default_rng(v_seed), candidates, layers, renderer, cache, batch=batch,
+                                                 **tag_telemetry(model_opts, "variance"))
     # print(f"    VGuess: {v_guess}")
-    r_guess, r_rmse, r_samples = test(grid, v_samples, uav_rows, radius, True, rmse_log_interval, display)
+    r_guess, r_rmse, r_samples, r_timings = test(grid, v_samples, uav_rows, radius, True, rmse_log_interval, display,
+                                                 np.random.default_rng(r_seed), candidates, layers, renderer, cache, **tag_telemetry(model_opts, "random"))
     # print(f"    RGuess: {r_guess}")
     return v_rmse, r_rmse
 
 
-def rmse_csv(size, src_amt, samples, uav_rows, radius):
+def rmse_csv(size, src_amt, samples, uav_rows, radius, seed=None, candidates=0, layers=1, cache=None, batch=0,
+             **model_opts):
     '''
     Generates a CSV formatted string of the RMSE at each sample, for both the random robot
     and the variance robot.
 
     Args: the same as compare()
     '''
-    v_rmse, r_rmse = compare(size, src_amt, samples, uav_rows, radius, 1, False)
+    v_rmse, r_rmse = compare(size, src_amt, samples, uav_rows, radius, 1, False, seed, candidates, layers, None, cache,
+                             batch, **model_opts)
 
-    res = "Sample,Variance RMSE,Random RMSE\n"
+    lines = ["Sample,Variance RMSE,Random RMSE\n"]
 
     for i in range(len(v_rmse)):
-        res += f"{i + 1},{v_rmse[i]},{r_rmse[i]}\n"
+        lines.append(f"{i + 1},{v_rmse[i]},{r_rmse[i]}\n")
 
-    return res
+    return "".join(lines)
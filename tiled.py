@@ -0,0 +1,232 @@
+'''
+A model made of local GPs on overlapping tiles, for sample sets too large for a single GP.
+'''
+
+import itertools
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from model import *
+
+
+def fit(expert):
+    '''
+    Builds an expert's regression. Returns the expert, so that it can be run in a worker process.
+    '''
+    expert.regression
+    return expert
+
+
+def new_model(d3=False, tile=0, overlap=0.25, workers=0, **model_opts):
+    '''
+    Creates a TiledModel if tile is above 0, or else a Model.
+    '''
+    if tile > 0:
+        return TiledModel(d3, tile, overlap, workers, **model_opts)
+    return Model(d3, **model_opts)
+
+
+class TiledModel(Model):
+    '''
+    A Model that splits space into a lattice of square tiles (cubes, in 3D), each with its own Model
+    (an expert) trained on the samples within overlap of the tile. A new sample only changes the experts
+    of the tiles it's near, so only they're refit, and each refit is of a small GP.
+
+    Predictions blend the experts whose tiles are within overlap of each point, weighted by distance:
+    1 inside a tile, falling linearly to 0 at overlap outside of it. The blended variance is the variance
+    of the mixture of the experts' predictions, so it grows where they disagree. Points that no tile
+    reaches use the nearest expert.
+    '''
+    def __init__(self, d3=False, tile=64, overlap=0.25, workers=0, **model_opts):
+        '''
+        Creates a new tiled model.
+
+        Args:
+        * tile: Width of the tiles.
+        * overlap: How far each expert reaches beyond its tile, as a fraction of tile.
+        * workers: If above 1, experts that need refitting are refit together in a process pool with
+          this many workers. Call close() to stop it.
+        * model_opts: Keyword arguments for Model, used for this model and each expert. Experts don't
+          get the telemetry sink.
+        '''
+        super(TiledModel, self).__init__(d3, **model_opts)
+        assert(tile > 0)
+        self.tile = tile
+        self.margin = overlap * tile
+        self.workers = workers
+        self.__expert_opts = {k: v for k, v in model_opts.items() if k != "telemetry"}
+        # Tile index (a tuple) -> Model
+        self.experts = {}
+        self.__pool = None
+
+    def close(self):
+        '''
+        Stops the process pool, if there is one.
+        '''
+        if self.__pool is not None:
+            self.__pool.shutdown()
+            self.__pool = None
+
+    def __point(self, pos):
+        return [pos.x, pos.y, pos.z] if self.d3 else [pos.x, pos.z]
+
+    def tiles_near(self, point):
+        '''
+        Indices of the tiles that reach point, which is a list of model coordinates.
+        '''
+        axes = [range(math.ceil((p - self.margin) / self.tile) - 1, math.floor((p + self.margin) / self.tile) + 1)
+                for p in point]
+        return [key for key in itertools.product(*axes) if self.__distance(key, np.array([point]))[0] <= self.margin]
+
+    def __outside(self, key, points):
+        '''
+        How far an (N, dims) array of points is outside tile key on each axis.
+        '''
+        lo = np.array(key) * self.tile
+        return np.maximum(np.maximum(lo - points, points - (lo + self.tile)), 0)
+
+    def __distance(self, key, points):
+        return np.sqrt((self.__outside(key, points) ** 2).sum(axis=1))
+
+    def __weights(self, key, points):
+        '''
+        Blending weights of the expert of tile key at an (N, dims) array of points.
+        '''
+        outside = self.__outside(key, points)
+        if self.margin <= 0:
+            return np.all(outside == 0, axis=1).astype(float)
+        return np.prod(np.clip(1 - outside / self.margin, 0, 1), axis=1)
+
+    def sample_many(self, samples):
+        '''
+        Adds a list of (position, value) samples to the model, and to the experts of every tile they're near.
+        '''
+        if len(samples) == 0:
+            return
+        self.append(samples)
+        touched = {}
+        for pos, val in samples:
+            for key in self.tiles_near(self.__point(pos)):
+                touched.setdefault(key, []).append((pos, val))
+        for key, subset in touched.items():
+            if key not in self.experts:
+                self.experts[key] = Model(self.d3, **self.__expert_opts)
+            self.experts[key].sample_many(subset)
+
+    def invalidate(self):
+        '''
+        Drops every expert's regression, so that they're all rebuilt and reoptimized on next use.
+        '''
+        super(TiledModel, self).invalidate()
+        for expert in self.experts.values():
+            expert.invalidate()
+
+    @property
+    def fitted(self):
+        return all(expert.fitted for expert in self.experts.values())
+
+    @property
+    def regression(self):
+        '''
+        Refits the experts that need it, together in the process pool if there is one. Returns the
+        dict of experts by tile index. Each expert's hyperparameter optimizations are added to
+        self.opt_log, with the tile index.
+        '''
+        stale = [key for key, expert in self.experts.items() if not expert.fitted]
+        if len(stale) == 0:
+            return self.experts
+        fits = [len(self.experts[key].opt_log) for key in stale]
+        with self.timer.phase("refit"):
+            if self.workers > 1 and len(stale) > 1:
+                if self.__pool is None:
+                    self.__pool = ProcessPoolExecutor(self.workers)
+                fitted = list(self.__pool.map(fit, [self.experts[key] for key in stale]))
+            else:
+                fitted = [fit(self.experts[key]) for key in stale]
+        for key, expert, n in zip(stale, fitted, fits):
+            self.experts[key] = expert
+            for entry in expert.opt_log[n:]:
+                self.opt_log.append(dict(entry, tile=list(key)))
+                if self.telemetry is not None:
+                    self.telemetry.event("timing", name="optimize", samples=entry["samples"], seconds=entry["time"])
+        return self.experts
+
+    @property
+    def chunk_size(self):
+        '''
+        As Model.chunk_size, but for the expert with the most samples.
+        '''
+        most = max([len(expert.input) for expert in self.experts.values()] + [1])
+        return max(1, self.predict_budget // (8 * 4 * most))
+
+    def predict_points(self, points, outputs="both"):
+        '''
+        Blends the experts' predictions at an (N, dims) array of points. Returns two (N, 1) arrays.
+        If outputs is "mean", the variance is None.
+        '''
+        experts = self.regression
+        points = np.asarray(points, dtype=float)
+        both = outputs != "mean"
+        total = np.zeros(len(points))
+        mean = np.zeros(len(points))
+        # Weighted sum of each expert's second moment, for the mixture's variance
+        second = np.zeros(len(points))
+
+        def add(expert, cells, weights):
+            m, v = expert.predict_points(points[cells], "both" if both else "mean")
+            total[cells] += weights
+            mean[cells] += weights * m[:, 0]
+            if both:
+                second[cells] += weights * (v[:, 0] + m[:, 0] ** 2)
+
+        for key, expert in experts.items():
+            weights = self.__weights(key, points)
+            cells = np.nonzero(weights > 0)[0]
+            if len(cells) > 0:
+                add(expert, cells, weights[cells])
+        uncovered = np.nonzero(total == 0)[0]
+        if len(uncovered) > 0:
+            keys = list(experts)
+            nearest = np.argmin(np.stack([self.__distance(key, points[uncovered]) for key in keys], axis=1), axis=1)
+            for i, key in enumerate(keys):
+                cells = uncovered[nearest == i]
+                if len(cells) > 0:
+                    add(experts[key], cells, np.ones(len(cells)))
+        mean /= total
+        if not both:
+            return mean[:, None], None
+        return mean[:, None], np.maximum(second / total - mean ** 2, 0)[:, None]
+
+    def fantasy(self):
+        '''
+        Not supported: there's no single posterior to add fantasized samples to. UGVs with a batch
+        planner refuse a TiledModel before getting here.
+        '''
+        raise ValueError("A TiledModel has no single posterior to fantasize samples with")
+
+    def state(self):
+        '''
+        As Model.state(), plus each expert's last optimized hyperparameters.
+        '''
+        state = super(TiledModel, self).state()
+        state["experts"] = [[list(key), expert.hyperparameters] for key, expert in self.experts.items()]
+        return state
+
+    def load_state(self, state):
+        '''
+        As Model.load_state(). Experts are rebuilt from the samples, and warm-started from their
+        saved hyperparameters. Every expert is reoptimized, including ones that wouldn't have been
+        refit yet, so a resumed run can differ slightly from one that wasn't interrupted.
+        '''
+        super(TiledModel, self).load_state(state)
+        self.experts = {}
+        inputs, outputs = self.input, self.output
+        self.input, self.output = [], []
+        samples = [(Vector(p[0], p[1], p[2]) if self.d3 else Vector(p[0], 0, p[1]), v[0]) for p, v in zip(inputs, outputs)]
+        telemetry, self.telemetry = self.telemetry, None
+        self.sample_many(samples)
+        self.telemetry = telemetry
+        for key, hyperparameters in state.get("experts", []):
+            if tuple(key) in self.experts:
+                self.experts[tuple(key)].hyperparameters = hyperparameters
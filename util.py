@@ -1,18 +1,28 @@
 import math
+import time
 import numpy as np
+from contextlib import contextmanager
+from operator import itemgetter
 
-class Vector(object):
+class Vector(tuple):
     '''
-    A 3D vector.
+    An immutable 3D vector. It's a tuple of (x, y, z), so it's compact, and it hashes and compares
+    like one.
     '''
-    def __init__(self, x, y=None, z=None):
+    __slots__ = ()
+
+    def __new__(cls, x, y=None, z=None):
         if y is None or z is None:
-            self.val = [x[0], x[1], x[2]]
-        else:
-            self.val = [x, y, z]
+            return tuple.__new__(cls, (x[0], x[1], x[2]))
+        return tuple.__new__(cls, (x, y, z))
+
+    x = property(itemgetter(0))
+    y = property(itemgetter(1))
+    z = property(itemgetter(2))
 
     def length(self):
-        return math.sqrt(self.x**2 + self.y**2 + self.z**2)
+        x, y, z = self
+        return math.sqrt(x * x + y * y + z * z)
 
     def distance(self, other):
         return (other - self).length()
@@ -23,18 +33,6 @@ class Vector(object):
     def in_circle(self, ctr, rad):
         return self.distance(ctr) <= rad
 
-    @property
-    def x(self):
-        return self[0]
-
-    @property
-    def y(self):
-        return self[1]
-
-    @property
-    def z(self):
-        return self[2]
-
     @property
     def xy(self):
         return (self[0], self[1])
@@ -48,43 +46,177 @@ class Vector(object):
         return (self[1], self[2])
 
     def __add__(self, other):
-        return Vector(self.x + other.x, self.y + other.y, self.z + other.z)
+        return Vector(self[0] + other[0], self[1] + other[1], self[2] + other[2])
 
     def __sub__(self, other):
-        return Vector(self.x - other.x, self.y - other.y, self.z - other.z)
+        return Vector(self[0] - other[0], self[1] - other[1], self[2] - other[2])
 
     def __mul__(self, o):
-        if o is Vector:
-            return Vector(self.x * o.x, self.y * o.y, self.z * o.z)
+        if isinstance(o, Vector):
+            return Vector(self[0] * o[0], self[1] * o[1], self[2] * o[2])
         else:
-            return Vector(self.x * o, self.y * o, self.z * o)
+            return Vector(self[0] * o, self[1] * o, self[2] * o)
+
+    # Otherwise, tuple's would repeat the vector
+    __rmul__ = __mul__
 
     def __truediv__(self, o):
-        return Vector(self.x / o, self.y / o, self.z / o)
+        return Vector(self[0] / o, self[1] / o, self[2] / o)
 
     def __floordiv__(self, o):
-        return Vector(self.x // o, self.y // o, self.z // o)
+        return Vector(self[0] // o, self[1] // o, self[2] // o)
 
     def __eq__(self, o):
-        return self.x == o[0] and self.y == o[1] and self.z == o[2]
+        return self[0] == o[0] and self[1] == o[1] and self[2] == o[2]
+
+    def __ne__(self, o):
+        return not self == o
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return f"Vector({self[0]}, {self[1]}, {self[2]})"
+
+    def __str__(self):
+        return f"[{self[0]}, {self[1]}, {self[2]}]"
+
+
+class Vectors(object):
+    '''
+    Many 3D vectors, stored as an (N, 3) numpy array, so that operations on all of them are vectorized.
+    '''
+    def __init__(self, val):
+        '''
+        Args:
+        * val: An (N, 3) array, or a list of Vectors or of 3-element sequences.
+        '''
+        self.val = np.asarray(val, dtype=float).reshape(-1, 3)
+
+    @property
+    def x(self):
+        return self.val[:, 0]
+
+    @property
+    def y(self):
+        return self.val[:, 1]
+
+    @property
+    def z(self):
+        return self.val[:, 2]
 
-    def __hash__(self):
-        return hash((self.x, self.y, self.z))
+    def length(self):
+        return np.sqrt(np.einsum("ij,ij->i", self.val, self.val))
+
+    def distance(self, other):
+        '''
+        Distance from each vector to other, which is either a Vector or Vectors of the same length.
+        '''
+        return (self - other).length()
+
+    def norm(self):
+        return Vectors(self.val / self.length()[:, None])
+
+    def in_circle(self, ctr, rad):
+        return self.distance(ctr) <= rad
+
+    def __add__(self, other):
+        return Vectors(self.val + _as_array(other))
+
+    def __sub__(self, other):
+        return Vectors(self.val - _as_array(other))
+
+    def __mul__(self, o):
+        return Vectors(self.val * _as_array(o))
+
+    def __truediv__(self, o):
+        return Vectors(self.val / _as_array(o))
+
+    def __len__(self):
+        return len(self.val)
 
     def __getitem__(self, item):
-        return self.val[item]
+        if isinstance(item, (int, np.integer)):
+            return Vector(*self.val[item].tolist())
+        return Vectors(self.val[item])
 
-    def __setitem__(self, key, value):
-        self.val[key] = value
+    def __iter__(self):
+        for row in self.val.tolist():
+            yield Vector(*row)
 
     def __repr__(self):
-        return f"Vector({self.x}, {self.y}, {self.z})"
+        return f"Vectors({self.val!r})"
+
+
+def _as_array(o):
+    '''
+    Converts the other operand of a Vectors operation to something that broadcasts against (N, 3).
+    Per-vector scalars should be passed as an (N, 1) array.
+    '''
+    if isinstance(o, Vectors):
+        return o.val
+    if isinstance(o, tuple):
+        return np.asarray(o, dtype=float)
+    return o
+
+
+class Timer(object):
+    '''
+    Counts calls and wall time of named phases (ex. "refit", "predict"). Phases can nest, and each
+    phase's time excludes that of the phases inside it, so the totals add up to the time spent.
+    '''
+    def __init__(self):
+        # Total seconds and amount of calls of each phase
+        self.seconds = {}
+        self.counts = {}
+        # [name, time at which it last started or resumed] for each running phase
+        self.__stack = []
+
+    def start(self, name):
+        now = time.perf_counter()
+        if len(self.__stack) > 0:
+            outer = self.__stack[-1]
+            self.seconds[outer[0]] += now - outer[1]
+        self.__stack.append([name, now])
+        self.seconds.setdefault(name, 0.0)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def stop(self):
+        now = time.perf_counter()
+        name, started = self.__stack.pop()
+        self.seconds[name] += now - started
+        if len(self.__stack) > 0:
+            self.__stack[-1][1] = now
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Times the body of a with statement as the phase name.
+        '''
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def merge(self, other):
+        '''
+        Adds the totals of another Timer to this one.
+        '''
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + other.counts[name]
+
+    def summary(self):
+        '''
+        Returns a dict from phase name to {"count": calls, "seconds": total seconds}.
+        '''
+        return {name: {"count": self.counts[name], "seconds": self.seconds[name]} for name in self.seconds}
 
     def __str__(self):
-        return f"[{self.x}, {self.y}, {self.z}]"
+        return ", ".join(f"{name}: {self.seconds[name]:.3f}s ({self.counts[name]})" for name in self.seconds)
 
 
-def rand_in_circle(pos, radius, y_radius=0):
+def rand_in_circle(pos, radius, y_radius=0, rng=None):
     '''
     Returns a random point in a circle. Not implemented for
     spheres.
@@ -93,9 +225,12 @@ def rand_in_circle(pos, radius, y_radius=0):
     * pos: Center of the circle.
     * radius: Radius of the circle on the xz plane.
     * y_radius: Radius of the circle on the yz plane. Not implemented.
+    * rng: The numpy.random.Generator to use. If None, the global numpy random state is used.
     '''
-    a = np.random.random() * 2 * math.pi
-    r = np.random.random() * radius
+    if rng is None:
+        rng = np.random
+    a = rng.random() * 2 * math.pi
+    r = rng.random() * radius
     if y_radius > 0:
         # unimplemented
         assert(False)
@@ -104,16 +239,22 @@ def rand_in_circle(pos, radius, y_radius=0):
     return Vector(r * math.cos(a), y, r * math.sin(a))
 
 
-def rand_point(rgn):
+def rand_point(rgn, rng=None):
     '''
     Returns a random point in a region.
+
+    Args:
+    * rgn: The region.
+    * rng: The numpy.random.Generator to use. If None, the global numpy random state is used.
     '''
-    x = np.random.random() * rgn.size.x - rgn.a.x
+    if rng is None:
+        rng = np.random
+    x = rng.random() * rgn.size.x + rgn.a.x
     if rgn.a.y == rgn.b.y:
         y = rgn.a.y
     else:
-        y = np.random.random() * rgn.size.y - rgn.a.y
-    z = np.random.random() * rgn.size.z - rgn.a.z
+        y = rng.random() * rgn.size.y + rgn.a.y
+    z = rng.random() * rgn.size.z + rgn.a.z
     return Vector(x, y, z)
 
 